@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# CPU cost per GB of the dump stream stages
+#
+# Usage: python benchmarks/bench_stream.py [MiB]
+
+import io
+import os
+import random
+import sys
+import time
+from dumpfreeze import stream
+
+GB = 1024 ** 3
+
+
+class NullFile(object):
+    """ Discard writes, so only stream CPU time is measured """
+
+    def write(self, data):
+        pass
+
+
+def sample_dump(size):
+    """ Generate mysqldump like INSERT statements """
+    rng = random.Random(0)
+    lines = []
+    total = 0
+    while total < size:
+        line = ('INSERT INTO `orders` VALUES (%d,%d,\'%s\',%.2f,'
+                '\'2018-08-%02d 12:%02d:%02d\');\n'
+                % (total, rng.randint(1, 10 ** 6),
+                   ''.join(rng.choice('abcdefghij') for _ in range(12)),
+                   rng.random() * 1000, rng.randint(1, 28),
+                   rng.randint(0, 59), rng.randint(0, 59))).encode('ascii')
+        lines.append(line)
+        total += len(line)
+    return b''.join(lines)[:size]
+
+
+def write_chunks(data, compress, key):
+    """ Run data through a writer pipeline, return (cpu, stored bytes) """
+    chunks = [data[i:i + stream.CHUNK_SIZE]
+              for i in range(0, len(data), stream.CHUNK_SIZE)]
+    sink = NullFile()
+    start = time.process_time()
+    writer, hasher = stream.open_writer(sink, compress, key)
+    for chunk in chunks:
+        writer.write(chunk)
+    writer.close()
+    return time.process_time() - start, hasher.size
+
+
+def read_back(data, compress, key):
+    """ Time decoding a stored stream, return cpu seconds """
+    class Collect(object):
+        def __init__(self):
+            self.parts = []
+
+        def write(self, data):
+            self.parts.append(data)
+
+    sink = Collect()
+    writer, _ = stream.open_writer(sink, compress, key)
+    writer.write(data)
+    writer.close()
+
+    stored = io.BytesIO(b''.join(sink.parts))
+    start = time.process_time()
+    size = sum(len(c) for c in stream.open_reader(stored, compress, key))
+    elapsed = time.process_time() - start
+    assert size == len(data)
+    return elapsed
+
+
+def main():
+    size = int(sys.argv[1] if len(sys.argv) > 1 else 256) * 1024 * 1024
+    data = sample_dump(size)
+    key = os.urandom(stream.KEY_SIZE)
+    scale = GB / float(size)
+
+    print('%d MiB sample, CPU seconds per GB of dump' % (size // 2 ** 20))
+    print('%-22s %10s %10s %10s' % ('STAGES', 'WRITE', 'READ', 'RATIO'))
+    for name, compress, use_key in (('sha256', False, None),
+                                    ('gzip+sha256', True, None),
+                                    ('aes-gcm+sha256', False, key),
+                                    ('gzip+aes-gcm+sha256', True, key)):
+        cpu, stored = write_chunks(data, compress, use_key)
+        read_cpu = read_back(data, compress, use_key)
+        print('%-22s %10.2f %10.2f %10.3f'
+              % (name, cpu * scale, read_cpu * scale, stored / float(size)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,666 @@
+# In process interface to dumpfreeze, the CLI is built on top of this
+
+import contextlib
+import datetime
+import os
+import time
+import uuid
+import botocore.exceptions
+import sqlalchemy as sa
+import sqlalchemy.orm
+from logging import getLogger
+from dumpfreeze import backup as bak
+from dumpfreeze import inventorydb
+from dumpfreeze import storage
+from dumpfreeze import stream
+
+logger = getLogger(__name__)
+
+# Format of Job.date
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+DEFAULT_LOCAL_DB = '~/.dumpfreeze/inventory.db'
+
+# Job.job_type of container inventory jobs, other jobs retrieve archives
+INVENTORY_JOB = 'inventory-retrieval'
+
+
+def now():
+    """ Current time, truncated to the precision stored in the db """
+    return datetime.datetime.utcnow().replace(microsecond=0)
+
+
+def previous_month(month):
+    """ Calendar month before a YYYY-MM month
+    Args:
+        month: month string, may be None or malformed
+    Returns:
+        Returns the previous YYYY-MM month, or None
+    """
+    try:
+        year, number = int(month[:4]), int(month[5:7])
+    except (TypeError, ValueError):
+        return None
+    if number == 1:
+        return '%04d-12' % (year - 1)
+    return '%04d-%02d' % (year, number - 1)
+
+
+class BackupManager(object):
+    """ Manage backups, archives and jobs against one local inventory
+
+    A single manager holds the inventory engine, session factory and
+    storage backends, and AWS calls go through the shared clients in
+    dumpfreeze.aws, so one instance can be reused for many operations.
+    Every method uses its own session, making a manager safe to share
+    between threads.
+    """
+
+    def __init__(self, local_db=DEFAULT_LOCAL_DB,
+                 keyfile=stream.DEFAULT_KEYFILE,
+                 storage_config=storage.DEFAULT_CONFIG):
+        """
+        Args:
+            local_db: Path to local inventory database
+            keyfile: Path to encryption key, read when first needed
+            storage_config: Path to storage backend config
+        """
+        # Check if db exists, if not create it
+        self.local_db = os.path.expanduser(local_db)
+        if not os.path.isfile(self.local_db):
+            inventorydb.setup_db(self.local_db)
+
+        self.engine = sa.create_engine('sqlite:///' + self.local_db)
+        inventorydb.upgrade_db(self.engine)
+
+        # Objects are handed back to callers after their session closes,
+        # so keep them loaded on commit
+        self.session_maker = sa.orm.sessionmaker(bind=self.engine,
+                                                 expire_on_commit=False)
+
+        # Daemon notification socket lives alongside the inventory
+        self.socket_path = os.path.join(os.path.dirname(self.local_db),
+                                        'daemon.sock')
+
+        self.keyfile = os.path.expanduser(keyfile)
+        self._key = None
+
+        self.backends = storage.load_backends(storage_config)
+
+    @property
+    def key(self):
+        """ Encryption key, loaded from the keyfile on first use """
+        if self._key is None:
+            self._key = stream.load_key(self.keyfile)
+        return self._key
+
+    @contextlib.contextmanager
+    def session(self):
+        """ Provide a session, committed on success and always closed """
+        local_db = self.session_maker()
+        try:
+            yield local_db
+            local_db.commit()
+        except Exception:
+            local_db.rollback()
+            raise
+        finally:
+            local_db.close()
+
+    def _get(self, model, **filters):
+        with self.session() as local_db:
+            return local_db.query(model).filter_by(**filters).one()
+
+    def _list(self, model):
+        with self.session() as local_db:
+            return local_db.query(model).all()
+
+    def _list_by(self, model, **filters):
+        with self.session() as local_db:
+            return local_db.query(model).filter_by(**filters).all()
+
+    def _store(self, obj):
+        with self.session() as local_db:
+            local_db.add(obj)
+        return obj
+
+    def _delete(self, obj):
+        with self.session() as local_db:
+            local_db.delete(obj)
+
+    def backend(self, name):
+        """ Get a storage backend by name
+        Args:
+            name: backend name, None for archives predating backends
+        Returns:
+            Returns a storage.StorageBackend
+        """
+        name = name or storage.DEFAULT_BACKEND
+        try:
+            return self.backends[name]
+        except KeyError:
+            raise ValueError('Unknown storage backend %s' % name)
+
+    def _backup_path(self, backup_info):
+        return bak.backup_path(backup_info.backup_dir,
+                               backup_info.id,
+                               backup_info.compressed,
+                               backup_info.encrypted)
+
+    # Backup operations
+    def get_backup(self, backup_uuid):
+        """ Get a backup by uuid, raises NoResultFound if missing """
+        return self._get(inventorydb.Backup, id=backup_uuid)
+
+    def list_backups(self):
+        """ Get all local backups """
+        return self._list(inventorydb.Backup)
+
+    def create_backup(self, database, user='root', backup_dir=None,
+                      compress=False, encrypt=False):
+        """ Create a mysqldump backup
+        Args:
+            database: Name of database to backup
+            user: Username to connect to mysql with
+            backup_dir: Path to backup directory, defaults to cwd
+            compress: gzip compress the dump
+            encrypt: encrypt the dump with the manager's key
+        Returns:
+            Returns the new inventorydb.Backup
+        """
+        backup_dir = backup_dir or os.getcwd()
+        backup_uuid = uuid.uuid4().hex
+        key = self.key if encrypt else None
+        start = time.monotonic()
+        _, checksum, raw_size, size = bak.create_dump(database,
+                                                      user,
+                                                      backup_dir,
+                                                      backup_uuid,
+                                                      compress,
+                                                      key)
+        duration = time.monotonic() - start
+
+        today = datetime.date.isoformat(datetime.datetime.today())
+
+        # Insert backup info into backup inventory db
+        backup_info = inventorydb.Backup(id=backup_uuid,
+                                         database_name=database,
+                                         backup_dir=backup_dir,
+                                         date=today,
+                                         compressed=compress,
+                                         encrypted=encrypt,
+                                         checksum=checksum,
+                                         raw_size=raw_size,
+                                         compressed_size=size,
+                                         duration=duration)
+        return self._store(backup_info)
+
+    def upload_backup(self, backup_uuid, vault, backend=None):
+        """ Upload a local backup dump to a storage backend
+        Args:
+            backup_uuid: uuid of backup
+            vault: Vault, bucket or directory to upload to
+            backend: Name of storage backend, defaults to Glacier
+        Returns:
+            Returns the new inventorydb.Archive
+        """
+        backup_info = self.get_backup(backup_uuid)
+        target = self.backend(backend)
+
+        vault = target.resolve_container(vault)
+        backup_path = self._backup_path(backup_info)
+        archived_size = os.path.getsize(backup_path)
+        object_id, location = target.upload(backup_path, vault)
+
+        # Insert archive info into archive inventory db
+        archive_info = inventorydb.Archive(
+            id=uuid.uuid4().hex,
+            aws_id=object_id,
+            location=location,
+            vault_name=vault,
+            backend=target.name,
+            backup_id=backup_info.id,
+            database_name=backup_info.database_name,
+            date=backup_info.date,
+            compressed=backup_info.compressed,
+            encrypted=backup_info.encrypted,
+            checksum=backup_info.checksum,
+            raw_size=backup_info.raw_size,
+            compressed_size=backup_info.compressed_size,
+            archived_size=archived_size,
+            duration=backup_info.duration)
+        return self._store(archive_info)
+
+    def restore_backup(self, backup_uuid, user='root'):
+        """ Restore a backup to its database
+        Args:
+            backup_uuid: uuid of backup
+            user: Username to connect to mysql with
+        """
+        backup_info = self.get_backup(backup_uuid)
+        bak.restore_dump(backup_info.database_name,
+                         user,
+                         backup_info.backup_dir,
+                         backup_info.id,
+                         backup_info.compressed,
+                         self.key if backup_info.encrypted else None)
+
+    def delete_backup(self, backup_uuid):
+        """ Delete a local dump backup and its inventory entry
+        Args:
+            backup_uuid: uuid of backup
+        """
+        backup_info = self.get_backup(backup_uuid)
+        os.remove(self._backup_path(backup_info))
+        self._delete(backup_info)
+
+    # Archive operations
+    def get_archive(self, archive_uuid):
+        """ Get an archive by uuid, raises NoResultFound if missing """
+        return self._get(inventorydb.Archive, id=archive_uuid)
+
+    def list_archives(self):
+        """ Get all uploaded archives """
+        return self._list(inventorydb.Archive)
+
+    def list_copies(self, archive_uuid):
+        """ Get every archive holding the same backup as an archive
+        Args:
+            archive_uuid: uuid of archive
+        Returns:
+            Returns a list of inventorydb.Archive, fastest backend first
+        """
+        archive_info = self.get_archive(archive_uuid)
+
+        # Older archives without a backup id can only be matched on
+        # their checksum, if they have one
+        if archive_info.backup_id:
+            copies = self._list_by(inventorydb.Archive,
+                                   backup_id=archive_info.backup_id)
+        elif archive_info.checksum:
+            copies = self._list_by(inventorydb.Archive,
+                                   checksum=archive_info.checksum)
+        else:
+            copies = [archive_info]
+
+        # Skip copies on backends no longer configured
+        copies = [c for c in copies
+                  if (c.backend or storage.DEFAULT_BACKEND) in self.backends]
+        return sorted(copies, key=lambda c: self.backend(c.backend).priority)
+
+    def delete_archive(self, archive_uuid):
+        """ Delete an archive from its backend and the inventory
+        Args:
+            archive_uuid: uuid of archive
+        """
+        archive_info = self.get_archive(archive_uuid)
+        self.backend(archive_info.backend).delete(archive_info)
+        self._delete(archive_info)
+
+    def retrieve_archive(self, archive_uuid, tier='Standard',
+                         backup_dir=None):
+        """ Retrieve an archive from the fastest backend holding a copy
+        Args:
+            archive_uuid: uuid of archive
+            tier: Glacier retrieval tier, one of Expedited, Standard or Bulk
+            backup_dir: Path to backup directory, defaults to cwd
+        Returns:
+            Returns the new inventorydb.Backup if the copy could be
+            downloaded immediately, otherwise the new inventorydb.Job
+        """
+        error = ValueError('No configured backend holds archive %s'
+                           % archive_uuid)
+        for archive_info in self.list_copies(archive_uuid):
+            source = self.backend(archive_info.backend)
+            try:
+                return self._retrieve_copy(archive_info, source, tier,
+                                           backup_dir)
+            # ValueError is a copy failing its checksum
+            except storage.BACKEND_ERRORS + (ValueError,) as e:
+                logger.error('Failed to retrieve archive %s from %s: %s',
+                             archive_info.id, source.name, e)
+                error = e
+
+        raise error
+
+    def _retrieve_copy(self, archive_info, source, tier, backup_dir):
+        """ Retrieve one copy of an archive, see retrieve_archive """
+        job_response = source.retrieve(archive_info, tier)
+
+        if job_response is None:
+            logger.info('Retrieving archive %s from %s',
+                        archive_info.id, source.name)
+            return self._download(archive_info, backup_dir)
+
+        # Insert job info into job inventory db
+        job_info = inventorydb.Job(account_id=job_response[0],
+                                   vault_name=job_response[1],
+                                   id=job_response[2],
+                                   tier=tier,
+                                   backend=source.name,
+                                   date=now().strftime(DATETIME_FORMAT))
+        return self._store(job_info)
+
+    def inventory(self, backend, container):
+        """ List what a container holds
+        Args:
+            backend: Name of storage backend
+            container: vault, bucket or directory
+        Returns:
+            Returns a list of object ids if the container could be listed
+            immediately, otherwise the new inventorydb.Job, whose
+            complete_job returns the list
+        """
+        source = self.backend(backend)
+        job_response = source.retrieve_inventory(container)
+
+        if job_response is None:
+            return source.inventory(container)
+
+        job_info = inventorydb.Job(account_id=job_response[0],
+                                   vault_name=job_response[1],
+                                   id=job_response[2],
+                                   job_type=INVENTORY_JOB,
+                                   backend=source.name,
+                                   date=now().strftime(DATETIME_FORMAT))
+        return self._store(job_info)
+
+    def _download(self, archive_info, backup_dir=None, job_info=None):
+        """ Stream an archive to a new backup file in its stored form,
+        it is decrypted and decompressed on restore
+        Args:
+            archive_info: inventorydb.Archive object
+            backup_dir: Path to backup directory, defaults to cwd
+            job_info: completed inventorydb.Job, removed once stored
+        Returns:
+            Returns the new inventorydb.Backup
+        """
+        backup_dir = backup_dir or os.getcwd()
+        source = self.backend(archive_info.backend)
+
+        backup_uuid = uuid.uuid4().hex
+        backup_path = bak.backup_path(backup_dir,
+                                      backup_uuid,
+                                      archive_info.compressed,
+                                      archive_info.encrypted)
+        try:
+            with contextlib.closing(source.download(archive_info,
+                                                    job_info)) as body:
+                checksum, size = storage.copy_to_file(body, backup_path)
+        except BaseException:
+            # Don't leave a partial download behind, even when interrupted
+            if os.path.exists(backup_path):
+                os.remove(backup_path)
+            raise
+
+        if archive_info.checksum and checksum != archive_info.checksum:
+            os.remove(backup_path)
+            raise ValueError('Checksum mismatch retrieving archive %s'
+                             % archive_info.id)
+
+        # Insert backup info and remove the finished job together.  No
+        # dump was run, so the dump size and duration are left unset to
+        # keep retrievals out of dump statistics
+        backup_info = inventorydb.Backup(
+            id=backup_uuid,
+            database_name=archive_info.database_name,
+            backup_dir=backup_dir,
+            date=archive_info.date,
+            compressed=archive_info.compressed,
+            encrypted=archive_info.encrypted,
+            checksum=checksum,
+            compressed_size=size,
+            source_archive_id=archive_info.id)
+        with self.session() as local_db:
+            local_db.add(backup_info)
+            if job_info is not None:
+                local_db.delete(local_db.merge(job_info))
+
+        return backup_info
+
+    # Job operations
+    def get_job(self, job_id):
+        """ Get a job by id, raises NoResultFound if missing """
+        return self._get(inventorydb.Job, id=job_id)
+
+    def list_jobs(self):
+        """ Get all active retrieval jobs """
+        return self._list(inventorydb.Job)
+
+    def delete_job(self, job_id):
+        """ Forget a job, such as one its backend no longer knows about
+        Args:
+            job_id: id of job
+        """
+        self._delete(self.get_job(job_id))
+
+    def check_job(self, job_info):
+        """ Check if a retrieval job is complete
+        Args:
+            job_info: inventorydb.Job object
+        Returns:
+            Returns True if job is complete
+        """
+        return self.backend(job_info.backend).check_job(job_info)
+
+    def complete_job(self, job_info, backup_dir=None):
+        """ Download the output of a completed job and store it as a backup
+        Args:
+            job_info: inventorydb.Job object
+            backup_dir: Path to backup directory, defaults to cwd
+        Returns:
+            Returns the new inventorydb.Backup, or the list of object ids
+            for an inventory job
+        """
+        source = self.backend(job_info.backend)
+
+        if job_info.job_type == INVENTORY_JOB:
+            object_ids = source.inventory(job_info.vault_name, job_info)
+            self._delete(job_info)
+            return object_ids
+
+        # Get corrosponding archive data
+        object_id = source.get_job_archive(job_info)
+        with self.session() as local_db:
+            query = local_db.query(inventorydb.Archive)
+            query = query.filter_by(aws_id=object_id)
+            # Archives from before backends were recorded are Glacier
+            if source.name == storage.DEFAULT_BACKEND:
+                query = query.filter(sa.or_(
+                    inventorydb.Archive.backend == source.name,
+                    inventorydb.Archive.backend.is_(None)))
+            else:
+                query = query.filter_by(backend=source.name)
+            archive_info = query.one()
+
+        return self._download(archive_info, backup_dir, job_info)
+
+    def poll_job(self, job_info, backup_dir=None):
+        """ Check a job and complete it if finished, removing it if its
+        backend no longer knows about it, such as once it has expired
+        Args:
+            job_info: inventorydb.Job object
+            backup_dir: Path to backup directory, defaults to cwd
+        Returns:
+            Returns the complete_job result, or None if the job is still
+            running or was removed
+        """
+        try:
+            completed = self.check_job(job_info)
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] != 'ResourceNotFoundException':
+                raise
+            logger.warning('Job %s no longer exists, removing it',
+                           job_info.id)
+            self.delete_job(job_info.id)
+            return None
+
+        if not completed:
+            return None
+        logger.info('Job %s complete, getting data', job_info.id)
+        return self.complete_job(job_info, backup_dir)
+
+    def poll_jobs(self, backup_dir=None):
+        """ Check every job for completion and store finished ones, a job
+        that fails to poll is logged and left for the next run
+        Args:
+            backup_dir: Path to backup directory, defaults to cwd
+        Returns:
+            Returns a list of complete_job results, new inventorydb.Backup
+            objects and object id lists of inventory jobs
+        """
+        results = []
+        for job_info in self.list_jobs():
+            logger.info('Checking job %s for completion', job_info.id)
+            try:
+                result = self.poll_job(job_info, backup_dir)
+            except Exception as e:
+                logger.error('Failed to poll job %s: %s', job_info.id, e)
+                continue
+            if result is not None:
+                results.append(result)
+        return results
+
+    # Statistics
+    def stats(self, top=10):
+        """ Storage accounting, aggregated in the inventory database so
+        rows are never loaded individually
+        Args:
+            top: number of largest backups to include
+        Returns:
+            Returns a dict with 'totals', 'databases', 'vaults', 'months'
+            and 'largest' entries
+        """
+        Backup = inventorydb.Backup
+        Archive = inventorydb.Archive
+
+        def total(column):
+            return sa.func.coalesce(sa.func.sum(column), 0)
+
+        # Retrieved backups take up local space but aren't dumps
+        def dumps():
+            return sa.func.count() - sa.func.count(Backup.source_archive_id)
+
+        with self.session() as local_db:
+            backup_totals = local_db.query(
+                sa.func.count(),
+                dumps(),
+                total(Backup.raw_size),
+                total(Backup.compressed_size)).one()
+            archive_totals = local_db.query(
+                sa.func.count(),
+                total(Archive.archived_size)).one()
+
+            databases = local_db.query(
+                Backup.database_name,
+                sa.func.count(),
+                dumps(),
+                total(Backup.raw_size),
+                total(Backup.compressed_size),
+                sa.func.avg(Backup.duration),
+                sa.func.max(Backup.date)).group_by(
+                    Backup.database_name).order_by(
+                        Backup.database_name).all()
+
+            vault_rows = local_db.query(
+                Archive.backend,
+                Archive.vault_name,
+                sa.func.count(),
+                total(Archive.archived_size)).group_by(
+                    Archive.backend, Archive.vault_name).all()
+
+            # Grouping on the plain columns lets sqlite walk the covering
+            # indexes in order, days are rolled up into months below
+            backup_days = local_db.query(
+                Backup.date,
+                sa.func.count(),
+                total(Backup.raw_size),
+                total(Backup.compressed_size)).group_by(Backup.date).all()
+            archive_days = local_db.query(
+                Archive.date,
+                sa.func.count(),
+                total(Archive.archived_size)).group_by(Archive.date).all()
+
+            largest = local_db.query(
+                Backup.id,
+                Backup.database_name,
+                Backup.date,
+                Backup.raw_size,
+                Backup.compressed_size).filter(
+                    Backup.compressed_size.isnot(None),
+                    Backup.source_archive_id.is_(None)).order_by(
+                        Backup.compressed_size.desc()).limit(top).all()
+
+        # Archives from before backends were recorded are Glacier
+        vaults = {}
+        for backend, vault, count, size in vault_rows:
+            backend = backend or storage.DEFAULT_BACKEND
+            entry = vaults.setdefault((backend, vault),
+                                      {'backend': backend,
+                                       'vault': vault,
+                                       'archives': 0,
+                                       'archived_size': 0})
+            entry['archives'] += count
+            entry['archived_size'] += size
+
+        # Roll days up into months, there is at most one row per day
+        # left at this point.  Dates are stored as YYYY-MM-DD strings
+        months = {}
+
+        def month_entry(date):
+            month = date[:7] if date else None
+            return months.setdefault(month, {'month': month,
+                                             'backups': 0,
+                                             'raw_size': 0,
+                                             'compressed_size': 0,
+                                             'archives': 0,
+                                             'archived_size': 0})
+
+        for date, count, raw_size, size in backup_days:
+            entry = month_entry(date)
+            entry['backups'] += count
+            entry['raw_size'] += raw_size
+            entry['compressed_size'] += size
+        for date, count, archived_size in archive_days:
+            entry = month_entry(date)
+            entry['archives'] += count
+            entry['archived_size'] += archived_size
+
+        # Growth compares against the previous calendar month, which
+        # has nothing stored if it is missing
+        for entry in months.values():
+            previous = months.get(previous_month(entry['month']), {})
+            for key, size in (('local_growth', 'compressed_size'),
+                              ('archived_growth', 'archived_size')):
+                before = previous.get(size)
+                if before:
+                    entry[key] = (entry[size] - before) / float(before)
+                else:
+                    entry[key] = None
+
+        return {
+            'totals': {'backups': backup_totals[0],
+                       'dumps': backup_totals[1],
+                       'raw_size': backup_totals[2],
+                       'compressed_size': backup_totals[3],
+                       'archives': archive_totals[0],
+                       'archived_size': archive_totals[1]},
+            'databases': [{'database': name,
+                           'backups': count,
+                           'dumps': dump_count,
+                           'raw_size': raw_size,
+                           'compressed_size': size,
+                           'average_duration': duration,
+                           'latest': latest}
+                          for (name, count, dump_count, raw_size, size,
+                               duration, latest) in databases],
+            'vaults': [vaults[k] for k in sorted(vaults, key=str)],
+            'months': [months[m] for m in sorted(months, key=str)],
+            'largest': [{'id': backup_id,
+                         'database': name,
+                         'date': date,
+                         'raw_size': raw_size,
+                         'compressed_size': size}
+                        for backup_id, name, date, raw_size, size
+                        in largest],
+        }
@@ -1,10 +1,249 @@
 # Operations pertaining to AWS services
+import binascii
+import hashlib
+import json
+import os
+import threading
+import concurrent.futures
 import botocore
 import boto3
 from logging import getLogger
+from dumpfreeze import throttle
+
+try:
+    from botocore.httpchecksum import AwsChunkedWrapper
+except ImportError:
+    # botocore before flexible checksums never wraps the body
+    AwsChunkedWrapper = None
 
 logger = getLogger(__name__)
 
+# Smallest multipart upload part size, must be a power of two number
+# of MiB.  Larger files use larger parts to stay within MAX_PARTS.
+PART_SIZE = 8 * 1024 * 1024
+
+# Glacier limits on multipart uploads, within S3's too
+MAX_PARTS = 10000
+MAX_PART_SIZE = 4 * 1024 ** 3
+
+# Parallel multipart upload workers
+UPLOAD_WORKERS = 4
+
+# Glacier tree hash leaf size
+TREE_HASH_CHUNK = 1024 * 1024
+
+# Shared boto clients, keyed by service name and endpoint
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(service='glacier', endpoint_url=None):
+    """ Get a shared boto client, creating it on first use
+    Args:
+        service: AWS service name
+        endpoint_url: Endpoint of an AWS compatible service, if not AWS
+    Returns:
+        Returns a boto client
+    """
+    # boto sessions are not thread safe, so guard client creation
+    with _clients_lock:
+        client = _clients.get((service, endpoint_url))
+        if client is None:
+            client = boto3.client(service, endpoint_url=endpoint_url)
+            # Pace throttled bodies only once the request is signed
+            events = client.meta.events
+            events.register_first('request-created.%s' % service,
+                                  _stop_pacing)
+            events.register_last('request-created.%s' % service,
+                                 _start_pacing)
+            if service == 'glacier':
+                for operation in ('UploadArchive', 'UploadMultipartPart'):
+                    client.meta.events.register_first(
+                        'before-call.glacier.%s' % operation,
+                        _add_content_sha256)
+            _clients[(service, endpoint_url)] = client
+    return client
+
+
+def _account_id(archive_info):
+    """ Get the AWS account id from an archive location """
+    return archive_info.location.split('/')[1]
+
+
+def _tree_hash(hashes):
+    """ Combine leaf digests into a Glacier tree hash
+    Args:
+        hashes: list of 1 MiB chunk sha256 digests
+    Returns:
+        Returns the hex tree hash
+    """
+    # An empty file hashes as a single empty chunk
+    hashes = hashes or [hashlib.sha256().digest()]
+    while len(hashes) > 1:
+        hashes = [hashlib.sha256(b''.join(hashes[i:i + 2])).digest()
+                  if i + 1 < len(hashes) else hashes[i]
+                  for i in range(0, len(hashes), 2)]
+    return binascii.hexlify(hashes[0]).decode('ascii')
+
+
+class _ThrottledPart(object):
+    """ Seekable window onto part of a file, sent through the upload limiter
+
+    Reads only draw from the limiter while botocore sends the request,
+    between request-created and the end of the send, so the bytes on the
+    wire are paced, including resends when botocore rewinds the body to
+    retry, while the passes botocore makes to checksum and sign the body
+    are neither paced nor counted.
+    """
+
+    def __init__(self, backup_path, offset, size):
+        self._file = open(backup_path, 'rb')
+        self._offset = offset
+        available = os.fstat(self._file.fileno()).st_size - offset
+        self._size = max(min(size, available), 0)
+        self._position = 0
+        self._paced = False
+
+    def __len__(self):
+        return self._size
+
+    def signal_transferring(self):
+        self._paced = True
+
+    def signal_not_transferring(self):
+        self._paced = False
+
+    def read(self, size=-1):
+        remaining = self._size - self._position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        self._file.seek(self._offset + self._position)
+        data = self._file.read(size)
+        if self._paced:
+            throttle.upload_limiter.consume(len(data))
+        self._position += len(data)
+        return data
+
+    def seek(self, position, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            position += self._position
+        elif whence == os.SEEK_END:
+            position += self._size
+        self._position = min(max(position, 0), self._size)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class _GlacierPart(_ThrottledPart):
+    """ Throttled part with the hashes Glacier needs computed up front """
+
+    def __init__(self, backup_path, offset, size):
+        super(_GlacierPart, self).__init__(backup_path, offset, size)
+        sha256 = hashlib.sha256()
+        self.leaves = []
+        for chunk in iter(lambda: self.read(TREE_HASH_CHUNK), b''):
+            sha256.update(chunk)
+            self.leaves.append(hashlib.sha256(chunk).digest())
+        self.seek(0)
+        self.sha256 = sha256.hexdigest()
+
+
+def _body(request):
+    """ Unwrap the request body botocore streams with trailing checksums """
+    body = request.body
+    if AwsChunkedWrapper is not None and isinstance(body, AwsChunkedWrapper):
+        body = body._raw
+    return body
+
+
+def _stop_pacing(request, **kwargs):
+    body = _body(request)
+    if isinstance(body, _ThrottledPart):
+        body.signal_not_transferring()
+
+
+def _start_pacing(request, **kwargs):
+    body = _body(request)
+    if isinstance(body, _ThrottledPart):
+        body.signal_transferring()
+
+
+def _add_content_sha256(params, **kwargs):
+    """ Give botocore the precomputed payload hash of a Glacier part,
+    sparing it another pass over the body
+    """
+    body = params.get('body')
+    if isinstance(body, _GlacierPart):
+        params['headers']['x-amz-content-sha256'] = body.sha256
+
+
+def _part_size(size):
+    """ Smallest part size keeping an upload within MAX_PARTS parts
+    Args:
+        size: size of the file in bytes
+    Returns:
+        Returns the part size in bytes
+    """
+    part_size = PART_SIZE
+    while part_size * MAX_PARTS < size:
+        part_size *= 2
+    if part_size > MAX_PART_SIZE:
+        raise ValueError('%d bytes is too large for a multipart upload'
+                         % size)
+    return part_size
+
+
+def _multipart_upload(client, backup_path, vault, size):
+    """ Upload a file in parts using parallel workers
+    Args:
+        client: boto glacier client
+        backup_path: Path to backup file
+        vault: Vault to upload to
+        size: size of the file in bytes
+    Returns:
+        Returns response from AWS
+    """
+    part_size = _part_size(size)
+    upload = client.initiate_multipart_upload(vaultName=vault,
+                                              partSize=str(part_size))
+    upload_id = upload['uploadId']
+
+    def send_part(offset):
+        with _GlacierPart(backup_path, offset, part_size) as part:
+            byte_range = 'bytes %d-%d/*' % (offset, offset + len(part) - 1)
+            client.upload_multipart_part(vaultName=vault,
+                                         uploadId=upload_id,
+                                         range=byte_range,
+                                         checksum=_tree_hash(part.leaves),
+                                         body=part)
+        logger.debug('Uploaded %s %s', backup_path, byte_range)
+        return part.leaves
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(UPLOAD_WORKERS) as pool:
+            parts = list(pool.map(send_part, range(0, size, part_size)))
+
+        # Parts are whole MiB, so their leaves make up the archive's tree
+        leaves = [leaf for part in parts for leaf in part]
+        return client.complete_multipart_upload(vaultName=vault,
+                                                uploadId=upload_id,
+                                                archiveSize=str(size),
+                                                checksum=_tree_hash(leaves))
+    except Exception:
+        client.abort_multipart_upload(vaultName=vault, uploadId=upload_id)
+        raise
+
 
 def glacier_upload(backup_path, vault):
     """ Upload db dump to Amazon Glaier
@@ -14,24 +253,30 @@ def glacier_upload(backup_path, vault):
     Returns:
         Returns response from AWS
     """
-    # Create boto aws client
-    client = boto3.client('glacier')
+    client = get_client()
 
     # Open db dump
     try:
-        with open(backup_path, 'rb') as dump:
-            # Upload dump
-            try:
-                response = client.upload_archive(vaultName=vault, body=dump)
-            except botocore.exceptions.NoCredentialsError:
-                logger.error('Credentials Not Found')
-                raise
-            except client.exceptions.ResourceNotFoundException:
-                logger.error('Vault not found')
-                raise
-            except botocore.exceptions.ClientError as e:
-                logger.error(e)
-                raise
+        size = os.path.getsize(backup_path)
+        # Upload dump, large dumps in parallel parts
+        try:
+            if size > PART_SIZE:
+                response = _multipart_upload(client, backup_path, vault, size)
+            else:
+                with _GlacierPart(backup_path, 0, size) as body:
+                    response = client.upload_archive(
+                        vaultName=vault,
+                        checksum=_tree_hash(body.leaves),
+                        body=body)
+        except botocore.exceptions.NoCredentialsError:
+            logger.error('Credentials Not Found')
+            raise
+        except client.exceptions.ResourceNotFoundException:
+            logger.error('Vault not found')
+            raise
+        except botocore.exceptions.ClientError as e:
+            logger.error(e)
+            raise
     except OSError:
         logger.error('Failed to open db dump %s for read', backup_path)
         raise
@@ -41,25 +286,110 @@ def glacier_upload(backup_path, vault):
     return response
 
 
-def retrieve_archive(archive_info):
+def s3_upload(client, backup_path, bucket, key, extra_args=None):
+    """ Upload a file to S3, large files in parallel parts, pacing the
+    bytes as they are sent
+    Args:
+        client: boto s3 client
+        backup_path: Path to backup file
+        bucket: Bucket to upload to
+        key: Object key to upload as
+        extra_args: further put_object and create_multipart_upload
+            arguments, such as StorageClass
+    """
+    extra_args = extra_args or {}
+    size = os.path.getsize(backup_path)
+    if size <= PART_SIZE:
+        with _ThrottledPart(backup_path, 0, size) as body:
+            client.put_object(Bucket=bucket, Key=key, Body=body,
+                              **extra_args)
+        return
+
+    part_size = _part_size(size)
+    upload = client.create_multipart_upload(Bucket=bucket, Key=key,
+                                            **extra_args)
+    upload_id = upload['UploadId']
+
+    def send_part(offset):
+        number = offset // part_size + 1
+        with _ThrottledPart(backup_path, offset, part_size) as part:
+            response = client.upload_part(Bucket=bucket,
+                                          Key=key,
+                                          UploadId=upload_id,
+                                          PartNumber=number,
+                                          Body=part)
+        logger.debug('Uploaded %s part %d', backup_path, number)
+        return {'ETag': response['ETag'], 'PartNumber': number}
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(UPLOAD_WORKERS) as pool:
+            parts = list(pool.map(send_part, range(0, size, part_size)))
+        client.complete_multipart_upload(Bucket=bucket,
+                                         Key=key,
+                                         UploadId=upload_id,
+                                         MultipartUpload={'Parts': parts})
+    except Exception:
+        client.abort_multipart_upload(Bucket=bucket, Key=key,
+                                      UploadId=upload_id)
+        raise
+
+
+def retrieve_archive(archive_info, tier='Standard'):
     """ Initates an archive retrieval job
     Args:
         archive_info: inventorydb.Archive object
+        tier: Glacier retrieval tier, one of Expedited, Standard or Bulk
     Returns:
         Returns job metadata
     """
-    # Create boto archive object
-    glacier = boto3.resource('glacier')
-    archive = glacier.Archive(archive_info.location.split('/')[1],
-                              archive_info.vault_name,
-                              archive_info.aws_id)
+    account_id = _account_id(archive_info)
 
     # Send request to initiate retrieval job
-    response = archive.initiate_archive_retrieval()
+    response = get_client().initiate_job(
+        accountId=account_id,
+        vaultName=archive_info.vault_name,
+        jobParameters={'Type': 'archive-retrieval',
+                       'ArchiveId': archive_info.aws_id,
+                       'Tier': tier})
+
+    logger.info('initated %s archive retrieval of %s',
+                tier, archive_info.id)
+
+    return((account_id, archive_info.vault_name, response['jobId']))
 
-    logger.info('initated archive retrieval of %s', archive)
 
-    return((response.account_id, response.vault_name, response.id))
+def retrieve_inventory(vault):
+    """ Initiates an inventory retrieval job
+    Args:
+        vault: Vault to list
+    Returns:
+        Returns job metadata
+    """
+    # Inventories are of vaults in the credentials' own account
+    account_id = '-'
+    response = get_client().initiate_job(
+        accountId=account_id,
+        vaultName=vault,
+        jobParameters={'Type': 'inventory-retrieval', 'Format': 'JSON'})
+
+    logger.info('initated inventory retrieval of %s', vault)
+
+    return (account_id, vault, response['jobId'])
+
+
+def get_inventory(job_info):
+    """ Read the output of a completed inventory retrieval job
+    Args:
+        job_info: inventorydb.Job object
+    Returns:
+        Returns the list of AWS archive ids in the vault
+    """
+    body = get_archive_data(job_info)
+    try:
+        inventory = json.loads(body.read().decode('utf-8'))
+    finally:
+        body.close()
+    return [item['ArchiveId'] for item in inventory['ArchiveList']]
 
 
 def delete_archive(archive_info):
@@ -67,15 +397,24 @@ def delete_archive(archive_info):
     Args:
         archive_info: inventorydb.Archive object
     """
-    # Create boto archive object
-    glacier = boto3.resource('glacier')
-    archive = glacier.Archive(archive_info.location.split('/')[1],
-                              archive_info.vault_name,
-                              archive_info.aws_id)
-    archive.delete()
+    get_client().delete_archive(accountId=_account_id(archive_info),
+                                vaultName=archive_info.vault_name,
+                                archiveId=archive_info.aws_id)
     logger.info('Deleted Archive %s', archive_info.id)
 
 
+def _describe_job(job_info):
+    """ Get job description from AWS
+    Args:
+        job_info: inventorydb.Job object
+    Returns:
+        Returns the job description
+    """
+    return get_client().describe_job(accountId=job_info.account_id,
+                                     vaultName=job_info.vault_name,
+                                     jobId=job_info.id)
+
+
 def check_job(job_info):
     """ Check if job is complete
     Args:
@@ -83,14 +422,7 @@ def check_job(job_info):
     Returns:
         Returns True if job is complete
     """
-    # Create boto job object
-    glacier = boto3.resource('glacier')
-    job = glacier.Job(job_info.account_id, job_info.vault_name, job_info.id)
-
-    # Reload job info
-    job.load()
-
-    return job.completed
+    return _describe_job(job_info)['Completed']
 
 
 def get_archive_data(job_info):
@@ -98,19 +430,13 @@ def get_archive_data(job_info):
     Args:
         job_info: inventorydb.Job object
     Returns:
-        Returns the archive body
+        Returns the archive body as a binary stream
     """
-    # Create boto job object
-    glacier = boto3.resource('glacier')
-    job = glacier.Job(job_info.account_id, job_info.vault_name, job_info.id)
-
-    # Get output
-    output = job.get_output()
+    output = get_client().get_job_output(accountId=job_info.account_id,
+                                         vaultName=job_info.vault_name,
+                                         jobId=job_info.id)
 
-    # Convert output from StreamingBody
-    body = output['body'].read().decode('utf-8')
-
-    return body
+    return output['body']
 
 
 def get_job_archive(job_info):
@@ -120,7 +446,4 @@ def get_job_archive(job_info):
     Returns:
         Returns the AWS archive id
     """
-    glacier = boto3.resource('glacier')
-    job = glacier.Job(job_info.account_id, job_info.vault_name, job_info.id)
-
-    return job.archive_iD
+    return _describe_job(job_info)['ArchiveId']
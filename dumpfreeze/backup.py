@@ -2,93 +2,178 @@
 
 import subprocess
 import os
+import tempfile
 from logging import getLogger
+from dumpfreeze import stream
+from dumpfreeze import throttle
 
 logger = getLogger(__name__)
 
 
-def create_dump(db_name, db_user, backup_dir, backup_uuid):
+def backup_path(backup_dir, backup_uuid, compressed=False, encrypted=False):
+    """ Get the path of a backup file
+    Args:
+        backup_dir: Path to backup directory
+        backup_uuid: uuid of backup
+        compressed: backup is gzip compressed
+        encrypted: backup is encrypted
+    Returns:
+        Returns the backup full path
+    """
+    backup_name = backup_uuid + '.sql'
+    if compressed:
+        backup_name += '.gz'
+    if encrypted:
+        backup_name += '.enc'
+    return os.path.join(backup_dir, backup_name)
+
+
+def _run(args, stdin=None, stdout=None, input=None):
+    """ Run a subprocess under the configured throttle priority
+    Args:
+        args: command arguments
+        stdin: file to feed to the command
+        stdout: writer to copy the command's output to at the dump rate
+        input: iterator of chunks to feed to the command instead of stdin
+    Returns:
+        Returns the number of bytes copied to stdout
+    Raises:
+        subprocess.CalledProcessError if the command fails
+    """
+    if input is not None:
+        stdin = subprocess.PIPE
+    copied = 0
+
+    # stderr goes to a file so it can't fill up while stdout is copied
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(args,
+                                   stdin=stdin,
+                                   stdout=subprocess.PIPE if stdout else None,
+                                   stderr=stderr)
+        throttle.register_process(process)
+        try:
+            if input is not None:
+                # A command exiting early is reported by its return code
+                try:
+                    for chunk in input:
+                        process.stdin.write(chunk)
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
+            if stdout:
+                while True:
+                    chunk = throttle.read(process.stdout,
+                                          throttle.CHUNK_SIZE,
+                                          throttle.dump_limiter)
+                    if not chunk:
+                        break
+                    stdout.write(chunk)
+                    copied += len(chunk)
+                process.stdout.close()
+            returncode = process.wait()
+        except BaseException:
+            process.kill()
+            process.wait()
+            raise
+        finally:
+            throttle.unregister_process(process)
+
+        if returncode:
+            stderr.seek(0)
+            message = stderr.read().decode('utf-8', 'replace')
+            raise subprocess.CalledProcessError(returncode, args,
+                                                stderr=message)
+
+    return copied
+
+
+def create_dump(db_name, db_user, backup_dir, backup_uuid,
+                compress=False, key=None):
     """ Generate mysqldump file for db_name
     Args:
         db_name: Name of database to backup
         db_user: Username to connect to mysql with
         backup_dir: Path to backup directory
         backup_uuid: uuid of backup
+        compress: gzip compress the dump
+        key: encryption key, None to leave the dump unencrypted
     Returns:
-        Returns the database backup full path
+        Returns (backup full path, sha256 checksum of the backup file,
+        size of the dump, size of the backup file)
     """
     # Set backup name
-    backup_name = backup_uuid + '.sql'
-    backup_path = os.path.join(backup_dir, backup_name)
+    path = backup_path(backup_dir, backup_uuid, compress, key is not None)
 
     # Open backup file for write
     try:
-        with open(backup_path, 'w') as backup_file:
+        with open(path, 'wb') as backup_file:
+            # Compress, encrypt and checksum in the same pass as the dump
+            writer, hasher = stream.open_writer(backup_file, compress, key)
             # mysqldump command
             dump_args = ['mysqldump', '--user=' + db_user, db_name]
-            # Run mysqldump command in subprocess
+            # Run mysqldump command in subprocess, copying its output
+            # through the dump limiter so a full pipe slows it down
             try:
-                subprocess.run(args=dump_args,
-                               stdout=backup_file,
-                               stderr=subprocess.PIPE,
-                               universal_newlines=True,
-                               check=True)
+                raw_size = _run(dump_args, stdout=writer)
             except subprocess.CalledProcessError as e:
                 logger.error(e.stderr)
                 raise
+            writer.close()
     except FileNotFoundError:
-        logger.error('Invalid path for %s', backup_path)
+        logger.error('Invalid path for %s', path)
         raise
     except PermissionError:
-        logger.error('Invalid permission to write to %s', backup_path)
+        logger.error('Invalid permission to write to %s', path)
         raise
     except OSError:
-        logger.error('Failed to open file %s for write', backup_path)
+        logger.error('Failed to open file %s for write', path)
         raise
 
-    logger.info('Created db dump at %s', backup_path)
+    logger.info('Created db dump at %s', path)
 
-    return backup_path
+    return path, hasher.checksum, raw_size, hasher.size
 
 
-def restore_dump(db_name, db_user, backup_dir, backup_uuid):
+def restore_dump(db_name, db_user, backup_dir, backup_uuid,
+                 compressed=False, key=None):
     """ Restore database dump with mysqldump
     Args:
         db_name: Name of database to restore
         db_user: Username to connect to mysql with
         backup_dir: Path to backup directory
         backup_uuid: uuid of backup
+        compressed: dump is gzip compressed
+        key: encryption key, None if the dump is unencrypted
     """
     # Set backup name
-    backup_name = backup_uuid + '.sql'
-    backup_path = os.path.join(backup_dir, backup_name)
+    path = backup_path(backup_dir, backup_uuid, compressed, key is not None)
 
-    # Open backup file for write
+    # Open backup file for read
     try:
-        with open(backup_path, 'r') as backup_file:
-            data = backup_file.read()
+        with open(path, 'rb') as backup_file:
             # mysql restore command
             dump_args = ['mysql',
                          '--user=' + db_user,
                          db_name]
-            # Run mysql command in subprocess
+            # Run mysql command in subprocess, decrypting and
+            # decompressing on the way in
             try:
-                subprocess.run(args=dump_args,
-                               stderr=subprocess.PIPE,
-                               universal_newlines=True,
-                               check=True,
-                               input=data)
+                if compressed or key is not None:
+                    chunks = stream.open_reader(backup_file, compressed, key)
+                    _run(dump_args, input=chunks)
+                else:
+                    _run(dump_args, stdin=backup_file)
             except subprocess.CalledProcessError as e:
                 logger.error(e.stderr)
                 raise
     except FileNotFoundError:
-        logger.error('Invalid path for %s', backup_path)
+        logger.error('Invalid path for %s', path)
         raise
     except PermissionError:
-        logger.error('Invalid permission to read %s', backup_path)
+        logger.error('Invalid permission to read %s', path)
         raise
     except OSError:
-        logger.error('Failed to open file %s for read', backup_path)
+        logger.error('Failed to open file %s for read', path)
         raise
 
-    logger.info('Created db dump at %s', backup_path)
+    logger.info('Restored db dump from %s', path)
@@ -0,0 +1,319 @@
+# Long running scheduler for backups and retrieval job polling
+
+import concurrent.futures
+import datetime
+import heapq
+import itertools
+import os
+import select
+import signal
+import socket
+from logging import getLogger
+from sqlalchemy.orm.exc import NoResultFound
+from dumpfreeze.api import DATETIME_FORMAT, INVENTORY_JOB, now
+
+logger = getLogger(__name__)
+
+# Per retrieval tier: (delay before first check, base recheck interval)
+TIER_SCHEDULE = {
+    'Expedited': (datetime.timedelta(minutes=1),
+                  datetime.timedelta(minutes=1)),
+    'Standard': (datetime.timedelta(hours=3),
+                 datetime.timedelta(minutes=15)),
+    'Bulk': (datetime.timedelta(hours=5),
+             datetime.timedelta(minutes=30)),
+}
+
+# Upper bound on the recheck interval, well inside the 24 hour
+# window Glacier keeps job output available
+MAX_POLL_INTERVAL = datetime.timedelta(hours=2)
+
+# Scheduled backups run one at a time, off the scheduling thread
+BACKUP_WORKERS = 1
+
+# Job checks and downloads run alongside backups on their own workers
+JOB_WORKERS = 2
+
+
+def next_poll(job_info, current, first_check=False):
+    """ Calculate when a job should next be checked for completion
+    Args:
+        job_info: inventorydb.Job object
+        current: current datetime
+        first_check: job hasn't been checked by this daemon yet
+    Returns:
+        Returns the datetime of the next check
+    """
+    first, interval = TIER_SCHEDULE.get(job_info.tier,
+                                        TIER_SCHEDULE['Standard'])
+
+    # Jobs created before tiers were recorded have no date, check them
+    # now and then at the tier's interval
+    try:
+        initiated = datetime.datetime.strptime(job_info.date,
+                                               DATETIME_FORMAT)
+    except (TypeError, ValueError):
+        return current if first_check else current + interval
+
+    # Don't bother checking before the tier could possibly be done
+    ready = initiated + first
+    if current < ready:
+        return ready
+
+    # Back off the longer a job stays incomplete
+    overdue = current - ready
+    return current + min(interval + overdue / 4, MAX_POLL_INTERVAL)
+
+
+def notify(socket_path, job_id):
+    """ Notify a running daemon of a new job
+    Args:
+        socket_path: Path to daemon notification socket
+        job_id: id of new job
+    Returns:
+        Returns True if a daemon received the notification
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.sendto(job_id.encode('utf-8'), socket_path)
+    except OSError:
+        logger.debug('No daemon listening on %s', socket_path)
+        return False
+    finally:
+        sock.close()
+
+    logger.info('Notified daemon of job %s', job_id)
+    return True
+
+
+class Daemon(object):
+    """ Scheduler running backups and job polls in a single process
+
+    The scheduling loop only receives notifications and queues actions,
+    backups and job polls run on worker threads so a long dump, upload
+    or download never holds it up.
+    """
+
+    def __init__(self, manager, backup_dir, databases=(), db_user='root',
+                 backup_interval=None, vault=None, backend=None,
+                 compress=False, encrypt=False):
+        """
+        Args:
+            manager: api.BackupManager to run operations with
+            backup_dir: Path to backup directory
+            databases: Names of databases to back up on schedule
+            db_user: Username to connect to mysql with
+            backup_interval: datetime.timedelta between scheduled backups
+            vault: Vault to upload scheduled backups to, if any
+            backend: Name of storage backend to upload to
+            compress: gzip compress scheduled backups
+            encrypt: encrypt scheduled backups
+        """
+        self.manager = manager
+        self.socket_path = manager.socket_path
+        self.backup_dir = backup_dir
+        self.databases = databases
+        self.db_user = db_user
+        self.backup_interval = backup_interval
+        self.vault = vault
+        self.backend = backend
+        self.compress = compress
+        self.encrypt = encrypt
+
+        self._queue = []
+        self._counter = itertools.count()
+        self._jobs = set()
+        self._sock = None
+
+        # Running actions by (action, key), reaped by the scheduling
+        # loop, which a finishing worker wakes through the socket pair
+        self._backup_executor = None
+        self._job_executor = None
+        self._running = {}
+        self._wakeup = None
+
+    def schedule(self, when, action, key):
+        """ Queue an action
+        Args:
+            when: datetime to run at
+            action: 'poll' or 'backup'
+            key: job id or database name
+        """
+        if action == 'poll':
+            if key in self._jobs:
+                return
+            self._jobs.add(key)
+        heapq.heappush(self._queue, (when, next(self._counter), action, key))
+        logger.debug('Scheduled %s of %s at %s', action, key, when)
+
+    def run(self):
+        """ Run until terminated """
+        signal.signal(signal.SIGTERM, self._terminate)
+        self._listen()
+        try:
+            self._load_jobs()
+            for database in self.databases:
+                self.schedule(now(), 'backup', database)
+
+            while True:
+                timeout = None
+                if self._queue:
+                    delay = self._queue[0][0] - now()
+                    timeout = max(delay.total_seconds(), 0)
+
+                readable, _, _ = select.select([self._sock, self._wakeup[0]],
+                                               [], [], timeout)
+                if self._sock in readable:
+                    self._receive()
+                if self._wakeup[0] in readable:
+                    self._wakeup[0].recv(1024)
+                self._reap()
+                self._run_pending()
+        finally:
+            self._close()
+
+    def _terminate(self, signum, frame):
+        logger.info('Received signal %s, shutting down', signum)
+        raise SystemExit(0)
+
+    def _listen(self):
+        """ Open the notification socket, replacing a stale one but
+        refusing to take over one a running daemon listens on
+        """
+        if os.path.exists(self.socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            try:
+                probe.connect(self.socket_path)
+            except OSError:
+                # Left behind by a daemon that didn't shut down cleanly
+                os.remove(self.socket_path)
+            else:
+                raise RuntimeError('Another daemon is listening on %s'
+                                   % self.socket_path)
+            finally:
+                probe.close()
+
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(self.socket_path)
+        logger.info('Listening for jobs on %s', self.socket_path)
+
+        self._wakeup = socket.socketpair()
+        self._backup_executor = concurrent.futures.ThreadPoolExecutor(
+            BACKUP_WORKERS)
+        self._job_executor = concurrent.futures.ThreadPoolExecutor(
+            JOB_WORKERS)
+
+    def _close(self):
+        if self._running:
+            logger.info('Waiting for running %s',
+                        ', '.join('%s of %s' % running
+                                  for running in sorted(self._running)))
+        self._backup_executor.shutdown()
+        self._job_executor.shutdown()
+        for sock in self._wakeup:
+            sock.close()
+        self._sock.close()
+        try:
+            os.remove(self.socket_path)
+        except OSError:
+            pass
+
+    def _receive(self):
+        """ Schedule a job received on the notification socket """
+        data = self._sock.recv(1024)
+        job_id = data.decode('utf-8').strip()
+        job_info = self._get_job(job_id)
+        if job_info is not None and job_info.job_type != INVENTORY_JOB:
+            self.schedule(next_poll(job_info, now(), first_check=True),
+                          'poll', job_id)
+
+    def _load_jobs(self):
+        """ Schedule every retrieval job already in the inventory, listings
+        of inventory jobs are left for poll-jobs to print
+        """
+        current = now()
+        for job_info in self.manager.list_jobs():
+            if job_info.job_type == INVENTORY_JOB:
+                continue
+            self.schedule(next_poll(job_info, current, first_check=True),
+                          'poll', job_info.id)
+
+    def _get_job(self, job_id):
+        """ Look up a job, returns None if it no longer exists """
+        try:
+            return self.manager.get_job(job_id)
+        except NoResultFound:
+            return None
+
+    def _run_pending(self):
+        """ Start every action that is due on a worker thread """
+        while self._queue and self._queue[0][0] <= now():
+            _, _, action, key = heapq.heappop(self._queue)
+            if action == 'poll':
+                self._jobs.discard(key)
+
+            if (action, key) in self._running:
+                # Next one is queued when the running one finishes
+                logger.debug('%s of %s still running, skipping',
+                             action, key)
+                continue
+
+            if action == 'poll':
+                future = self._job_executor.submit(self._poll, key)
+            else:
+                future = self._backup_executor.submit(self._create_backup,
+                                                      key)
+            self._running[(action, key)] = future
+            future.add_done_callback(lambda f: self._wakeup[1].send(b'\0'))
+
+    def _reap(self):
+        """ Log finished actions and queue the next of each """
+        for (action, key), future in list(self._running.items()):
+            if not future.done():
+                continue
+            del self._running[(action, key)]
+
+            error = future.exception()
+            if action == 'poll':
+                if error is not None:
+                    logger.error('Failed to poll job %s: %s', key, error)
+                # Completed and unknown jobs are gone from the inventory
+                job_info = self._get_job(key)
+                if job_info is not None:
+                    self.schedule(next_poll(job_info, now()), 'poll', key)
+            else:
+                if error is not None:
+                    logger.error('Scheduled backup of %s failed: %s',
+                                 key, error)
+                if self.backup_interval:
+                    self.schedule(now() + self.backup_interval, 'backup',
+                                  key)
+
+    def _poll(self, job_id):
+        """ Check a job, downloading its output if complete """
+        # Job may have been handled by poll-jobs in the meantime
+        job_info = self._get_job(job_id)
+        if job_info is None:
+            return
+
+        logger.info('Checking job %s for completion', job_id)
+        backup_info = self.manager.poll_job(job_info, self.backup_dir)
+        if backup_info is not None:
+            logger.info('Stored job %s as backup %s', job_id, backup_info.id)
+
+    def _create_backup(self, database):
+        """ Dump a database and optionally upload it """
+        backup_info = self.manager.create_backup(database,
+                                                 self.db_user,
+                                                 self.backup_dir,
+                                                 self.compress,
+                                                 self.encrypt)
+        logger.info('Created scheduled backup %s of %s',
+                    backup_info.id, database)
+
+        if self.vault:
+            self.manager.upload_backup(backup_info.id,
+                                       self.vault,
+                                       self.backend)
+            logger.info('Uploaded scheduled backup %s to %s',
+                        backup_info.id, self.vault)
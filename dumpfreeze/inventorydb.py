@@ -9,14 +9,32 @@ base = sqlalchemy.ext.declarative.declarative_base()
 
 
 class Archive(base):
-    """ AWS Glacier archive object """
+    """ Archive stored on a storage backend """
     __tablename__ = 'archive'
     id = sa.Column(sa.String, primary_key=True)
-    aws_id = sa.Column(sa.String)
+    aws_id = sa.Column(sa.String, index=True)
     location = sa.Column(sa.String)
     vault_name = sa.Column(sa.String)
+    backend = sa.Column(sa.String)
+    backup_id = sa.Column(sa.String, index=True)
     database_name = sa.Column(sa.String)
     date = sa.Column(sa.String)
+    compressed = sa.Column(sa.Boolean)
+    encrypted = sa.Column(sa.Boolean)
+    checksum = sa.Column(sa.String)
+    # Sizes in bytes of the dump, the backup file and the upload
+    raw_size = sa.Column(sa.BigInteger)
+    compressed_size = sa.Column(sa.BigInteger)
+    archived_size = sa.Column(sa.BigInteger)
+    # Seconds taken to create the dump
+    duration = sa.Column(sa.Float)
+
+    # Covering indexes so storage stats are answered from the index
+    __table_args__ = (
+        sa.Index('ix_archive_vault_stats',
+                 'backend', 'vault_name', 'archived_size'),
+        sa.Index('ix_archive_date_stats', 'date', 'archived_size'),
+    )
 
     def store(self, session):
         """ store object in db
@@ -56,6 +74,25 @@ class Backup(base):
     database_name = sa.Column(sa.String)
     backup_dir = sa.Column(sa.String)
     date = sa.Column(sa.String)
+    compressed = sa.Column(sa.Boolean)
+    encrypted = sa.Column(sa.Boolean)
+    checksum = sa.Column(sa.String)
+    # Sizes in bytes of the dump and of the backup file
+    raw_size = sa.Column(sa.BigInteger)
+    compressed_size = sa.Column(sa.BigInteger, index=True)
+    # Seconds taken to create the dump
+    duration = sa.Column(sa.Float)
+    # Archive a retrieved backup was downloaded from, None for dumps
+    source_archive_id = sa.Column(sa.String)
+
+    # Covering indexes so storage stats are answered from the index
+    __table_args__ = (
+        sa.Index('ix_backup_database_usage', 'database_name', 'date',
+                 'raw_size', 'compressed_size', 'duration',
+                 'source_archive_id'),
+        sa.Index('ix_backup_date_stats',
+                 'date', 'raw_size', 'compressed_size'),
+    )
 
     def store(self, session):
         """ store object in db
@@ -94,6 +131,11 @@ class Job(base):
     account_id = sa.Column(sa.String)
     vault_name = sa.Column(sa.String)
     id = sa.Column(sa.String, primary_key=True)
+    # Glacier job type, archive-retrieval when not set
+    job_type = sa.Column(sa.String)
+    tier = sa.Column(sa.String)
+    backend = sa.Column(sa.String)
+    date = sa.Column(sa.String)
 
     def store(self, session):
         """ store object in db
@@ -126,6 +168,31 @@ class Job(base):
             session.close()
 
 
+def upgrade_db(engine):
+    """ Add any columns and indexes missing from an older inventory database
+    Args:
+        engine: sqlalchemy engine bound to the local database
+    """
+    inspector = sa.inspect(engine)
+    for table in base.metadata.sorted_tables:
+        existing = set(c['name'] for c in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_type = column.type.compile(engine.dialect)
+            with engine.begin() as conn:
+                conn.execute(sa.text('ALTER TABLE %s ADD COLUMN %s %s'
+                                     % (table.name, column.name,
+                                        column_type)))
+            logger.info('Added column %s.%s', table.name, column.name)
+
+        existing = set(i['name'] for i in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine)
+                logger.info('Added index %s', index.name)
+
+
 def setup_db(local_db):
     """ Initialize database
     Args:
@@ -2,14 +2,16 @@
 # Create MySQL dumps and backup to Amazon Glacier
 
 import os
+import json
 import logging
 import datetime
 import click
-import uuid
-import sqlalchemy as sa
-from dumpfreeze import backup as bak
-from dumpfreeze import aws
+from dumpfreeze import api
+from dumpfreeze import daemon as dmn
 from dumpfreeze import inventorydb
+from dumpfreeze import storage
+from dumpfreeze import stream
+from dumpfreeze import throttle
 from dumpfreeze import __version__
 
 logger = logging.getLogger(__name__)
@@ -20,12 +22,62 @@ def abort_if_false(ctx, param, value):
         ctx.abort()
 
 
+def print_table(header, rows):
+    """ Print rows as aligned columns
+    Args:
+        header: list of column titles
+        rows: list of rows, each a list of strings
+    """
+    formatted = [header] + rows
+
+    # Calculate widths
+    widths = [max(map(len, column)) for column in zip(*formatted)]
+
+    for row in formatted:
+        print("  ".join((val.ljust(width)
+              for val, width in zip(row, widths))))
+
+
+def format_size(size):
+    """ Format a byte count for people
+    Args:
+        size: number of bytes, or None if unknown
+    Returns:
+        Returns a string such as 1.5G
+    """
+    if size is None:
+        return '-'
+    for unit in ('B', 'K', 'M', 'G', 'T'):
+        if abs(size) < 1024 or unit == 'T':
+            break
+        size /= 1024.0
+    if unit == 'B':
+        return '%d%s' % (size, unit)
+    return '%.1f%s' % (size, unit)
+
+
+def format_growth(growth):
+    """ Format a growth ratio as a percentage, '-' if unknown """
+    if growth is None:
+        return '-'
+    return '%+.1f%%' % (growth * 100)
+
+
 @click.group()
 @click.option('-v', '--verbose', count=True)
-@click.option('--local-db', default='~/.dumpfreeze/inventory.db')
+@click.option('--local-db', default=api.DEFAULT_LOCAL_DB)
+@click.option('--throttle-config',
+              default=throttle.DEFAULT_CONFIG,
+              help='Rate and priority limits, reloaded on SIGHUP')
+@click.option('--keyfile',
+              default=stream.DEFAULT_KEYFILE,
+              help='Encryption key file')
+@click.option('--storage-config',
+              default=storage.DEFAULT_CONFIG,
+              help='Storage backend definitions')
 @click.version_option(__version__, prog_name='dumpfreeze')
 @click.pass_context
-def main(ctx, verbose, local_db):
+def main(ctx, verbose, local_db, throttle_config, keyfile, storage_config):
     """ Create and manage MySQL dumps locally and on AWS Glacier """
     # Set logger verbosity
     if verbose == 1:
@@ -37,15 +89,15 @@ def main(ctx, verbose, local_db):
     else:
         logging.basicConfig(level=logging.CRITICAL)
 
-    # Check if db exists, if not create it
-    expanded_db_path = os.path.expanduser(local_db)
-    if not os.path.isfile(expanded_db_path):
-        inventorydb.setup_db(expanded_db_path)
-
-    # Create db session
-    db_engine = sa.create_engine('sqlite:///' + expanded_db_path)
-    Session = sa.orm.sessionmaker(bind=db_engine)
-    ctx.obj['session_maker'] = Session
+    try:
+        throttle.load_config(throttle_config)
+        throttle.reload_on_sighup(throttle_config)
+        ctx.obj['manager'] = api.BackupManager(local_db,
+                                               keyfile,
+                                               storage_config)
+    except Exception as e:
+        logger.critical(e)
+        raise SystemExit(1)
     return
 
 
@@ -62,71 +114,45 @@ def backup(ctx):
 @click.option('--backup-dir',
               default=os.getcwd(),
               help='Backup storage directory')
+@click.option('--compress', is_flag=True, help='gzip compress the dump')
+@click.option('--encrypt', is_flag=True, help='Encrypt the dump')
 @click.argument('database')
 @click.pass_context
-def create_backup(ctx, database, user, backup_dir):
+def create_backup(ctx, database, user, backup_dir, compress, encrypt):
     """ Create a mysqldump backup"""
-    backup_uuid = uuid.uuid4().hex
     try:
-        bak.create_dump(database, user, backup_dir, backup_uuid)
+        backup_info = ctx.obj['manager'].create_backup(database,
+                                                       user,
+                                                       backup_dir,
+                                                       compress,
+                                                       encrypt)
     except Exception as e:
         logger.critical(e)
         raise SystemExit(1)
 
-    today = datetime.date.isoformat(datetime.datetime.today())
-
-    # Insert backup info into backup inventory db
-    backup_info = inventorydb.Backup(id=backup_uuid,
-                                     database_name=database,
-                                     backup_dir=backup_dir,
-                                     date=today)
-    local_db = ctx.obj['session_maker']()
-    backup_info.store(local_db)
-
-    click.echo(backup_uuid)
+    click.echo(backup_info.id)
 
 
 @backup.command('upload')
-@click.option('--vault', required=True, help='Vault to upload to')
+@click.option('--vault',
+              required=True,
+              help='Vault, bucket or directory to upload to')
+@click.option('--backend',
+              default=storage.DEFAULT_BACKEND,
+              help='Storage backend to upload to')
 @click.argument('backup_uuid', metavar='UUID')
 @click.pass_context
-def upload_backup(ctx, vault, backup_uuid):
-    """ Upload a local backup dump to AWS Glacier """
-    # Get backup info
-    local_db = ctx.obj['session_maker']()
+def upload_backup(ctx, vault, backend, backup_uuid):
+    """ Upload a local backup dump to a storage backend """
     try:
-        query = local_db.query(inventorydb.Backup)
-        backup_info = query.filter_by(id=backup_uuid).one()
+        archive_info = ctx.obj['manager'].upload_backup(backup_uuid,
+                                                        vault,
+                                                        backend)
     except Exception as e:
         logger.critical(e)
-        local_db.rollback()
         raise SystemExit(1)
-    finally:
-        local_db.close()
 
-    # Construct backup path
-    backup_file = backup_info.id + '.sql'
-    backup_path = os.path.join(backup_info.backup_dir, backup_file)
-
-    # Upload backup_file to Glacier
-    try:
-        upload_response = aws.glacier_upload(backup_path, vault)
-    except Exception as e:
-        logger.critical(e)
-        raise SystemExit(1)
-
-    archive_uuid = uuid.uuid4().hex
-    # Insert archive info into archive inventory db
-    archive_info = inventorydb.Archive(id=archive_uuid,
-                                       aws_id=upload_response['archiveId'],
-                                       location=upload_response['location'],
-                                       vault_name=vault,
-                                       database_name=backup_info.database_name,
-                                       date=backup_info.date)
-    local_db = ctx.obj['session_maker']()
-    archive_info.store(local_db)
-
-    click.echo(archive_uuid)
+    click.echo(archive_info.id)
 
 
 @backup.command('restore')
@@ -135,23 +161,11 @@ def upload_backup(ctx, vault, backup_uuid):
 @click.pass_context
 def restore_backup(ctx, user, backup_uuid):
     """ Restore a backup to the database """
-    # Get backup info
-    local_db = ctx.obj['session_maker']()
     try:
-        query = local_db.query(inventorydb.Backup)
-        backup_info = query.filter_by(id=backup_uuid).one()
+        ctx.obj['manager'].restore_backup(backup_uuid, user)
     except Exception as e:
         logger.critical(e)
-        local_db.rollback()
         raise SystemExit(1)
-    finally:
-        local_db.close()
-
-    # Restore backup to database
-    bak.restore_dump(backup_info.database_name,
-                     user,
-                     backup_info.backup_dir,
-                     backup_info.id)
 
 
 @backup.command('delete')
@@ -165,30 +179,13 @@ def restore_backup(ctx, user, backup_uuid):
 @click.pass_context
 def delete_backup(ctx, backup_uuid):
     """ Delete a local dump backup """
-    # Get backup info
-    local_db = ctx.obj['session_maker']()
     try:
-        query = local_db.query(inventorydb.Backup)
-        backup_info = query.filter_by(id=backup_uuid).one()
+        ctx.obj['manager'].delete_backup(backup_uuid)
     except Exception as e:
         logger.critical(e)
-        local_db.rollback()
         raise SystemExit(1)
-    finally:
-        local_db.close()
-
-    # Construct backup path
-    backup_file = backup_info.id + '.sql'
-    backup_path = os.path.join(backup_info.backup_dir, backup_file)
 
-    # Delete file
-    os.remove(backup_path)
-
-    # Remove from db
-    local_db = ctx.obj['session_maker']()
-    backup_info.delete(local_db)
-
-    click.echo(backup_info.id)
+    click.echo(backup_uuid)
 
 
 @backup.command('list')
@@ -196,15 +193,11 @@ def delete_backup(ctx, backup_uuid):
 def list_backup(ctx):
     """ Return a list of all local backups """
     # Get Inventory
-    local_db = ctx.obj['session_maker']()
     try:
-        backups = local_db.query(inventorydb.Backup).all()
+        backups = ctx.obj['manager'].list_backups()
     except Exception as e:
         logger.critical(e)
-        local_db.rollback()
         raise SystemExit(1)
-    finally:
-        local_db.close()
 
     # do some formatting for printing
     formatted = []
@@ -214,23 +207,14 @@ def list_backup(ctx):
                           backup.backup_dir,
                           backup.date])
 
-    # Add header
-    formatted.insert(0, ['UUID', 'DATABASE', 'LOCATION', 'DATE'])
-
-    # Calculate widths
-    widths = [max(map(len, column)) for column in zip(*formatted)]
-
-    # Print inventory
-    for row in formatted:
-        print("  ".join((val.ljust(width)
-              for val, width in zip(row, widths))))
+    print_table(['UUID', 'DATABASE', 'LOCATION', 'DATE'], formatted)
 
 
 # Archive operations
 @click.group()
 @click.pass_context
 def archive(ctx):
-    """ Operations on AWS Glacier Archives """
+    """ Operations on stored archives """
     pass
 
 
@@ -244,56 +228,65 @@ def archive(ctx):
               prompt='Delete archive?')
 @click.pass_context
 def delete_archive(ctx, archive_uuid):
-    """ Delete an archive on AWS Glacier """
-    # Get archive info
-    local_db = ctx.obj['session_maker']()
+    """ Delete an archive from its storage backend """
     try:
-        query = local_db.query(inventorydb.Archive)
-        archive_info = query.filter_by(id=archive_uuid).one()
+        ctx.obj['manager'].delete_archive(archive_uuid)
     except Exception as e:
         logger.critical(e)
-        local_db.rollback()
         raise SystemExit(1)
-    finally:
-        local_db.close()
-
-    # Send delete job to AWS
-    aws.delete_archive(archive_info)
-
-    # Remove from db
-    local_db = ctx.obj['session_maker']()
-    archive_info.delete(local_db)
 
     click.echo(archive_uuid)
 
 
 @archive.command('retrieve')
+@click.option('--tier',
+              default='Standard',
+              type=click.Choice(['Expedited', 'Standard', 'Bulk']),
+              help='Glacier retrieval tier')
+@click.option('--backup-dir',
+              default=os.getcwd(),
+              help='Backup storage directory')
 @click.argument('archive_uuid', metavar='UUID')
 @click.pass_context
-def retrieve_archive(ctx, archive_uuid):
-    """ Initiate an archive retrieval from AWS Glacier """
-    # Get archive info
-    local_db = ctx.obj['session_maker']()
+def retrieve_archive(ctx, tier, backup_dir, archive_uuid):
+    """ Retrieve an archive from the fastest backend holding a copy """
+    manager = ctx.obj['manager']
     try:
-        query = local_db.query(inventorydb.Archive)
-        archive_info = query.filter_by(id=archive_uuid).one()
+        result = manager.retrieve_archive(archive_uuid, tier, backup_dir)
     except Exception as e:
         logger.critical(e)
-        local_db.rollback()
         raise SystemExit(1)
-    finally:
-        local_db.close()
 
-    # Initiate archive retrieval job
-    job_response = aws.retrieve_archive(archive_info)
+    if isinstance(result, inventorydb.Backup):
+        click.echo(result.id)
+        return
+
+    # Let a running daemon schedule polling for the new job
+    dmn.notify(manager.socket_path, result.id)
+
+
+@archive.command('inventory')
+@click.option('--backend',
+              default=storage.DEFAULT_BACKEND,
+              help='Storage backend to list')
+@click.argument('vault')
+@click.pass_context
+def inventory_archive(ctx, backend, vault):
+    """ List the objects a vault, bucket or directory holds, Glacier
+    listings are jobs printed by poll-jobs once complete
+    """
+    try:
+        result = ctx.obj['manager'].inventory(backend, vault)
+    except Exception as e:
+        logger.critical(e)
+        raise SystemExit(1)
 
-    # Insert backup info into backup inventory db
-    job_info = inventorydb.Job(account_id=job_response[0],
-                               vault_name=job_response[1],
-                               id=job_response[2])
+    if isinstance(result, inventorydb.Job):
+        click.echo(result.id)
+        return
 
-    local_db = ctx.obj['session_maker']()
-    job_info.store(local_db)
+    for object_id in result:
+        click.echo(object_id)
 
 
 @archive.command('list')
@@ -301,34 +294,44 @@ def retrieve_archive(ctx, archive_uuid):
 def list_archive(ctx):
     """ Return a list of uploaded archives """
     # Get inventory
-    local_db = ctx.obj['session_maker']()
     try:
-        archives = local_db.query(inventorydb.Archive).all()
+        archives = ctx.obj['manager'].list_archives()
     except Exception as e:
         logger.critical(e)
-        local_db.rollback()
         raise SystemExit(1)
-    finally:
-        local_db.close()
 
     # do some formatting for printing
     formatted = []
     for archive in archives:
         formatted.append([archive.id,
+                          archive.backend or storage.DEFAULT_BACKEND,
                           archive.vault_name,
                           archive.database_name,
                           archive.date])
 
-    # Add header
-    formatted.insert(0, ('UUID', 'VAULT', 'DATABASE', 'DATE'))
+    print_table(['UUID', 'BACKEND', 'VAULT', 'DATABASE', 'DATE'], formatted)
 
-    # Calculate widths
-    widths = [max(map(len, column)) for column in zip(*formatted)]
 
-    # Print inventory
-    for row in formatted:
-        print("  ".join((val.ljust(width)
-              for val, width in zip(row, widths))))
+# Key operations
+@click.group()
+@click.pass_context
+def key(ctx):
+    """ Operations on the encryption key """
+    pass
+
+
+@key.command('generate')
+@click.pass_context
+def generate_key(ctx):
+    """ Generate a new encryption key """
+    keyfile = ctx.obj['manager'].keyfile
+    try:
+        stream.generate_key(keyfile)
+    except Exception as e:
+        logger.critical(e)
+        raise SystemExit(1)
+
+    click.echo(keyfile)
 
 
 @click.command('poll-jobs')
@@ -337,66 +340,140 @@ def poll_jobs(ctx):
     """ Check each job in job list, check for completion,
     and download job data
     """
-    # Get job list
-    local_db = ctx.obj['session_maker']()
     try:
-        job_list = local_db.query(inventorydb.Job).all()
+        results = ctx.obj['manager'].poll_jobs(os.getcwd())
+    except Exception as e:
+        logger.critical(e)
+        raise SystemExit(1)
+
+    for result in results:
+        if isinstance(result, inventorydb.Backup):
+            click.echo(result.id)
+        else:
+            # Inventory job, print the listing
+            for object_id in result:
+                click.echo(object_id)
+
+
+@click.command('stats')
+@click.option('--top', default=10, help='Number of largest backups to show')
+@click.option('--json', 'as_json', is_flag=True, help='Output as JSON')
+@click.pass_context
+def stats(ctx, top, as_json):
+    """ Show storage used per database, vault and month """
+    try:
+        results = ctx.obj['manager'].stats(top)
+    except Exception as e:
+        logger.critical(e)
+        raise SystemExit(1)
+
+    if as_json:
+        click.echo(json.dumps(results, indent=2, sort_keys=True))
+        return
+
+    totals = results['totals']
+    print('%d backups (%d dumps), %s dumped, %s stored locally' % (
+        totals['backups'],
+        totals['dumps'],
+        format_size(totals['raw_size']),
+        format_size(totals['compressed_size'])))
+    print('%d archives, %s archived' % (
+        totals['archives'], format_size(totals['archived_size'])))
+
+    print('')
+    print_table(['DATABASE', 'BACKUPS', 'DUMPS', 'RAW', 'STORED',
+                 'AVG TIME', 'LATEST'],
+                [[row['database'] or '-',
+                  str(row['backups']),
+                  str(row['dumps']),
+                  format_size(row['raw_size']),
+                  format_size(row['compressed_size']),
+                  '-' if row['average_duration'] is None
+                  else '%.0fs' % row['average_duration'],
+                  row['latest'] or '-']
+                 for row in results['databases']])
+
+    print('')
+    print_table(['BACKEND', 'VAULT', 'ARCHIVES', 'ARCHIVED'],
+                [[row['backend'],
+                  row['vault'] or '-',
+                  str(row['archives']),
+                  format_size(row['archived_size'])]
+                 for row in results['vaults']])
+
+    print('')
+    print_table(['MONTH', 'BACKUPS', 'STORED', 'GROWTH', 'ARCHIVES',
+                 'ARCHIVED', 'GROWTH'],
+                [[row['month'] or '-',
+                  str(row['backups']),
+                  format_size(row['compressed_size']),
+                  format_growth(row['local_growth']),
+                  str(row['archives']),
+                  format_size(row['archived_size']),
+                  format_growth(row['archived_growth'])]
+                 for row in results['months']])
+
+    print('')
+    print_table(['UUID', 'DATABASE', 'DATE', 'RAW', 'STORED'],
+                [[row['id'],
+                  row['database'] or '-',
+                  row['date'] or '-',
+                  format_size(row['raw_size']),
+                  format_size(row['compressed_size'])]
+                 for row in results['largest']])
+
+
+@click.command('daemon')
+@click.option('--database',
+              multiple=True,
+              help='Database to back up on schedule, may be repeated')
+@click.option('--user', default='root', help='Database user')
+@click.option('--backup-dir',
+              default=os.getcwd(),
+              help='Backup storage directory')
+@click.option('--backup-interval',
+              default=24,
+              type=int,
+              help='Hours between scheduled backups')
+@click.option('--vault', help='Vault to upload scheduled backups to')
+@click.option('--backend',
+              default=storage.DEFAULT_BACKEND,
+              help='Storage backend to upload scheduled backups to')
+@click.option('--compress', is_flag=True, help='gzip compress dumps')
+@click.option('--encrypt', is_flag=True, help='Encrypt dumps')
+@click.pass_context
+def daemon(ctx, database, user, backup_dir, backup_interval, vault,
+           backend, compress, encrypt):
+    """ Run scheduled backups and poll jobs in a long running process """
+    scheduler = dmn.Daemon(ctx.obj['manager'],
+                           backup_dir,
+                           databases=database,
+                           db_user=user,
+                           backup_interval=datetime.timedelta(
+                               hours=backup_interval),
+                           vault=vault,
+                           backend=backend,
+                           compress=compress,
+                           encrypt=encrypt)
+    try:
+        scheduler.run()
     except Exception as e:
         logger.critical(e)
-        local_db.rollback()
         raise SystemExit(1)
-    finally:
-        local_db.close()
-
-    # Check for job completion
-    for job in job_list:
-        logger.info('Checking job %s for completion', job.id)
-        if aws.check_job(job):
-            logger.info('Job %s complete, getting data', job.id)
-            # Pull archive data
-            backup_data = aws.get_archive_data(job)
-
-            # Store backup data as new file
-            backup_dir = os.getcwd()
-            backup_uuid = uuid.uuid4().hex
-            backup_file = backup_uuid + '.sql'
-            backup_path = os.path.join(backup_dir, backup_file)
-
-            with open(backup_path, 'w') as f:
-                f.write(backup_data)
-
-            # Get corrosponding archive data
-            archive_id = aws.get_job_archive(job)
-            local_db = ctx.obj['session_maker']()
-            try:
-                query = local_db.query(inventorydb.Archive)
-                archive_info = query.filter_by(aws_id=archive_id).one()
-            except Exception as e:
-                logger.critical(e)
-                local_db.rollback()
-                raise SystemExit(1)
-            finally:
-                local_db.close()
-
-            database_name = archive_info.database_name
-            backup_date = archive_info.date
-
-            # Insert backup info into backup inventory db
-            backup_info = inventorydb.Backup(id=backup_uuid,
-                                             database_name=database_name,
-                                             backup_dir=backup_dir,
-                                             date=backup_date)
-            local_db = ctx.obj['session_maker']()
-            backup_info.store(local_db)
-
-            # Delete job from db
-            local_db = ctx.obj['session_maker']()
-            job.delete(local_db)
-
-        click.echo(backup_uuid)
 
 
 main.add_command(backup)
 main.add_command(archive)
+main.add_command(key)
 main.add_command(poll_jobs, name='poll-jobs')
-main(obj={})
+main.add_command(stats)
+main.add_command(daemon)
+
+
+def run():
+    """ Console script entry point """
+    main(obj={})
+
+
+if __name__ == '__main__':
+    run()
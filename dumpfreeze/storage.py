@@ -0,0 +1,310 @@
+# Storage backends archives can be kept on
+
+import configparser
+import os
+import shutil
+import uuid
+import botocore.exceptions
+from logging import getLogger
+from dumpfreeze import aws
+from dumpfreeze import stream
+from dumpfreeze import throttle
+
+logger = getLogger(__name__)
+
+DEFAULT_CONFIG = '~/.dumpfreeze/storage.ini'
+
+# Backend used for archives recorded before backends existed
+DEFAULT_BACKEND = 'glacier'
+
+# Errors raised when a backend can't provide a copy, such as a missing
+# file or object, after which another copy may still be tried
+BACKEND_ERRORS = (OSError,
+                  botocore.exceptions.BotoCoreError,
+                  botocore.exceptions.ClientError)
+
+
+class StorageBackend(object):
+    """ Base class for places archives are stored
+
+    Archives live in a container, a Glacier vault, S3 bucket or
+    directory, and are identified within it by an object id stored in
+    Archive.aws_id.  Backends with a lower priority are faster to
+    restore from.
+    """
+    priority = 0
+
+    def __init__(self, name, priority=None):
+        self.name = name
+        if priority is not None:
+            self.priority = priority
+
+    def resolve_container(self, container):
+        """ Normalize a container as given by the user for storing
+        Args:
+            container: vault, bucket or directory
+        Returns:
+            Returns the container as recorded in Archive.vault_name
+        """
+        return container
+
+    def upload(self, backup_path, container):
+        """ Store a backup file
+        Args:
+            backup_path: Path to backup file
+            container: vault, bucket or directory to store in
+        Returns:
+            Returns (object id, location)
+        """
+        raise NotImplementedError
+
+    def delete(self, archive_info):
+        """ Delete a stored archive
+        Args:
+            archive_info: inventorydb.Archive object
+        """
+        raise NotImplementedError
+
+    def retrieve(self, archive_info, tier='Standard'):
+        """ Start making an archive available for download
+        Args:
+            archive_info: inventorydb.Archive object
+            tier: retrieval tier, for backends that have them
+        Returns:
+            Returns job metadata (account id, container, job id), or None
+            if the archive can be downloaded immediately
+        """
+        return None
+
+    def check_job(self, job_info):
+        """ Check if a retrieval job is complete
+        Args:
+            job_info: inventorydb.Job object
+        Returns:
+            Returns True if job is complete
+        """
+        return True
+
+    def get_job_archive(self, job_info):
+        """ Get the object id a retrieval job is for
+        Args:
+            job_info: inventorydb.Job object
+        """
+        raise NotImplementedError
+
+    def download(self, archive_info, job_info=None):
+        """ Open a stored archive for reading
+        Args:
+            archive_info: inventorydb.Archive object
+            job_info: completed inventorydb.Job, for backends with jobs
+        Returns:
+            Returns a binary stream of the archive
+        """
+        raise NotImplementedError
+
+    def retrieve_inventory(self, container):
+        """ Start listing what a container holds
+        Args:
+            container: vault, bucket or directory
+        Returns:
+            Returns job metadata (account id, container, job id), or None
+            if the container can be listed immediately
+        """
+        return None
+
+    def inventory(self, container, job_info=None):
+        """ List what a container holds
+        Args:
+            container: vault, bucket or directory
+            job_info: completed inventorydb.Job, for backends with jobs
+        Returns:
+            Returns a list of object ids
+        """
+        raise NotImplementedError
+
+
+class GlacierBackend(StorageBackend):
+    """ Amazon Glacier, retrievals are jobs taking minutes to hours """
+    priority = 20
+
+    def upload(self, backup_path, container):
+        response = aws.glacier_upload(backup_path, container)
+        return response['archiveId'], response['location']
+
+    def delete(self, archive_info):
+        aws.delete_archive(archive_info)
+
+    def retrieve(self, archive_info, tier='Standard'):
+        return aws.retrieve_archive(archive_info, tier)
+
+    def check_job(self, job_info):
+        return aws.check_job(job_info)
+
+    def get_job_archive(self, job_info):
+        return aws.get_job_archive(job_info)
+
+    def download(self, archive_info, job_info=None):
+        return aws.get_archive_data(job_info)
+
+    def retrieve_inventory(self, container):
+        return aws.retrieve_inventory(container)
+
+    def inventory(self, container, job_info=None):
+        if job_info is None:
+            raise ValueError('Glacier inventories are only available '
+                             'through an inventory retrieval job')
+        return aws.get_inventory(job_info)
+
+
+class LocalBackend(StorageBackend):
+    """ Directory on a local or network filesystem, such as NFS """
+    priority = 0
+
+    def _path(self, archive_info):
+        return os.path.join(archive_info.vault_name, archive_info.aws_id)
+
+    def resolve_container(self, container):
+        # Relative directories would resolve elsewhere from another cwd
+        return os.path.abspath(container)
+
+    def upload(self, backup_path, container):
+        object_id = uuid.uuid4().hex
+        path = os.path.join(self.resolve_container(container), object_id)
+        partial = path + '.part'
+
+        # Copy under a temporary name so a half written file is never
+        # mistaken for an archive
+        try:
+            with open(backup_path, 'rb') as src, open(partial, 'wb') as dst:
+                reader = throttle.ThrottledReader(src,
+                                                  throttle.upload_limiter)
+                shutil.copyfileobj(reader, dst, throttle.CHUNK_SIZE)
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.rename(partial, path)
+        except OSError:
+            logger.error('Failed to copy %s to %s', backup_path, container)
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+
+        logger.info('Copied %s to %s', backup_path, path)
+        return object_id, path
+
+    def delete(self, archive_info):
+        os.remove(self._path(archive_info))
+        logger.info('Deleted Archive %s', archive_info.id)
+
+    def download(self, archive_info, job_info=None):
+        return open(self._path(archive_info), 'rb')
+
+    def inventory(self, container, job_info=None):
+        return sorted(name for name in os.listdir(container)
+                      if not name.endswith('.part'))
+
+
+class S3Backend(StorageBackend):
+    """ Amazon S3 or an S3 compatible object store """
+    priority = 10
+
+    def __init__(self, name, priority=None, endpoint_url=None,
+                 storage_class=None):
+        """
+        Args:
+            name: Name of backend
+            priority: Restore preference, lower is faster
+            endpoint_url: Endpoint of an S3 compatible service, if not AWS
+            storage_class: S3 storage class to upload with
+        """
+        super(S3Backend, self).__init__(name, priority)
+        self.endpoint_url = endpoint_url
+        self.storage_class = storage_class
+
+    @property
+    def client(self):
+        return aws.get_client('s3', self.endpoint_url)
+
+    def upload(self, backup_path, container):
+        object_id = uuid.uuid4().hex
+        extra_args = {}
+        if self.storage_class:
+            extra_args['StorageClass'] = self.storage_class
+
+        aws.s3_upload(self.client, backup_path, container, object_id,
+                      extra_args)
+
+        location = '/%s/%s' % (container, object_id)
+        logger.info('Uploaded %s to S3 %s', backup_path, location)
+        return object_id, location
+
+    def delete(self, archive_info):
+        self.client.delete_object(Bucket=archive_info.vault_name,
+                                  Key=archive_info.aws_id)
+        logger.info('Deleted Archive %s', archive_info.id)
+
+    def download(self, archive_info, job_info=None):
+        response = self.client.get_object(Bucket=archive_info.vault_name,
+                                          Key=archive_info.aws_id)
+        return response['Body']
+
+    def inventory(self, container, job_info=None):
+        paginator = self.client.get_paginator('list_objects_v2')
+        return [item['Key']
+                for page in paginator.paginate(Bucket=container)
+                for item in page.get('Contents', [])]
+
+
+BACKEND_TYPES = {
+    'glacier': GlacierBackend,
+    'local': LocalBackend,
+    's3': S3Backend,
+}
+
+
+def load_backends(path=DEFAULT_CONFIG):
+    """ Build the available backends
+
+    One backend of each type is always available under the type's name.
+    Each section of the config file adds or overrides a backend named
+    after the section, for example:
+
+        [warm]
+        type = s3
+        endpoint_url = https://minio.example.com
+        priority = 5
+
+    Args:
+        path: Path to config file
+    Returns:
+        Returns a dict of backend name to StorageBackend
+    """
+    backends = dict((name, cls(name)) for name, cls in BACKEND_TYPES.items())
+
+    parser = configparser.ConfigParser()
+    parser.read(os.path.expanduser(path))
+    for name in parser.sections():
+        options = dict(parser[name])
+        backend_type = options.pop('type', name)
+        if backend_type not in BACKEND_TYPES:
+            raise ValueError('Unknown storage type %s for backend %s'
+                             % (backend_type, name))
+        if 'priority' in options:
+            options['priority'] = int(options['priority'])
+        backends[name] = BACKEND_TYPES[backend_type](name, **options)
+
+    return backends
+
+
+def copy_to_file(source, backup_path):
+    """ Stream an archive into a backup file
+    Args:
+        source: binary stream of archive data
+        backup_path: Path to write to
+    Returns:
+        Returns (sha256 checksum, size) of the data written
+    """
+    with open(backup_path, 'wb') as f:
+        hasher = stream.HashingWriter(f)
+        for chunk in stream.read_chunks(source):
+            hasher.write(chunk)
+    return hasher.checksum, hasher.size
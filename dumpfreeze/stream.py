@@ -0,0 +1,253 @@
+# Single pass compression, encryption and checksumming of dump streams
+
+import hashlib
+import os
+import struct
+import zlib
+from logging import getLogger
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+    AESGCM = None
+
+logger = getLogger(__name__)
+
+DEFAULT_KEYFILE = '~/.dumpfreeze/backup.key'
+
+KEY_SIZE = 32
+
+# Plaintext bytes per encrypted chunk
+CHUNK_SIZE = 64 * 1024
+
+# Encrypted file header: magic, format version, random nonce prefix
+MAGIC = b'DFZE'
+VERSION = 1
+NONCE_PREFIX_SIZE = 7
+HEADER_SIZE = len(MAGIC) + 1 + NONCE_PREFIX_SIZE
+
+# Each chunk is framed by its ciphertext length, the top bit marks
+# the final chunk so truncated files fail to decrypt
+FRAME = struct.Struct('>I')
+FINAL_BIT = 0x80000000
+TAG_SIZE = 16
+
+# gzip framing for zlib
+GZIP_WBITS = 31
+
+# Fast compression keeps up with mysqldump, higher levels cost around
+# three times the CPU for a few percent smaller output
+COMPRESS_LEVEL = 1
+
+
+def _aesgcm(key):
+    if AESGCM is None:
+        raise RuntimeError('Encryption requires the cryptography package')
+    return AESGCM(key)
+
+
+def _nonce(prefix, counter, final):
+    """ 96 bit nonce unique to each chunk of a file """
+    return prefix + struct.pack('>I?', counter, final)
+
+
+def generate_key(keyfile):
+    """ Write a new random key, readable only by the owner
+    Args:
+        keyfile: Path to write the key to
+    """
+    fd = os.open(keyfile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(os.urandom(KEY_SIZE))
+    logger.info('Generated key %s', keyfile)
+
+
+def load_key(keyfile):
+    """ Read an encryption key
+    Args:
+        keyfile: Path to key file
+    Returns:
+        Returns the key bytes
+    """
+    with open(keyfile, 'rb') as f:
+        key = f.read()
+    if len(key) != KEY_SIZE:
+        raise ValueError('Key file %s must hold %d bytes'
+                         % (keyfile, KEY_SIZE))
+    return key
+
+
+class HashingWriter(object):
+    """ Write to a file, tracking the sha256 and size of what passed """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.size = 0
+        self._hash = hashlib.sha256()
+
+    @property
+    def checksum(self):
+        return self._hash.hexdigest()
+
+    def write(self, data):
+        self._hash.update(data)
+        self.size += len(data)
+        self.fileobj.write(data)
+
+    def close(self):
+        pass
+
+
+class CompressingWriter(object):
+    """ gzip compress data on its way to the next writer """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self._compressor = zlib.compressobj(COMPRESS_LEVEL,
+                                            wbits=GZIP_WBITS)
+
+    def write(self, data):
+        compressed = self._compressor.compress(data)
+        if compressed:
+            self.writer.write(compressed)
+
+    def close(self):
+        self.writer.write(self._compressor.flush())
+        self.writer.close()
+
+
+class EncryptingWriter(object):
+    """ AES-GCM encrypt data in fixed size chunks on its way to the
+    next writer
+    """
+
+    def __init__(self, writer, key):
+        self.writer = writer
+        self._aesgcm = _aesgcm(key)
+        self._prefix = os.urandom(NONCE_PREFIX_SIZE)
+        self._header = MAGIC + bytes([VERSION]) + self._prefix
+        self._counter = 0
+        self._buffer = bytearray()
+        self.writer.write(self._header)
+
+    def _emit(self, chunk, final):
+        nonce = _nonce(self._prefix, self._counter, final)
+        ciphertext = self._aesgcm.encrypt(nonce, bytes(chunk), self._header)
+        length = len(ciphertext) | (FINAL_BIT if final else 0)
+        self.writer.write(FRAME.pack(length) + ciphertext)
+        self._counter += 1
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) > CHUNK_SIZE:
+            self._emit(self._buffer[:CHUNK_SIZE], False)
+            del self._buffer[:CHUNK_SIZE]
+
+    def close(self):
+        # Always finish with a final chunk, even if it is empty
+        self._emit(self._buffer, True)
+        self._buffer = bytearray()
+        self.writer.close()
+
+
+def open_writer(fileobj, compress=False, key=None):
+    """ Build a writer pipeline ending in fileobj
+    Args:
+        fileobj: binary file to write to
+        compress: gzip compress the data
+        key: encryption key, None to leave unencrypted
+    Returns:
+        Returns (writer, hasher), close writer when done and read the
+        stored size and checksum from hasher
+    """
+    hasher = HashingWriter(fileobj)
+    writer = hasher
+    if key is not None:
+        writer = EncryptingWriter(writer, key)
+    if compress:
+        writer = CompressingWriter(writer)
+    return writer, hasher
+
+
+def read_chunks(fileobj, size=CHUNK_SIZE):
+    """ Iterate over a file in chunks """
+    return iter(lambda: fileobj.read(size), b'')
+
+
+def _read_exact(fileobj, size):
+    data = fileobj.read(size)
+    if len(data) != size:
+        raise ValueError('Encrypted backup is truncated')
+    return data
+
+
+def decrypt_chunks(fileobj, key):
+    """ Decrypt a file written by EncryptingWriter
+    Args:
+        fileobj: binary file to read from
+        key: encryption key
+    Returns:
+        Returns an iterator of plaintext chunks
+    """
+    aesgcm = _aesgcm(key)
+    header = _read_exact(fileobj, HEADER_SIZE)
+    if header[:len(MAGIC)] != MAGIC or header[len(MAGIC)] != VERSION:
+        raise ValueError('Not an encrypted dumpfreeze backup')
+    prefix = header[len(MAGIC) + 1:]
+
+    counter = 0
+    while True:
+        length, = FRAME.unpack(_read_exact(fileobj, FRAME.size))
+        final = bool(length & FINAL_BIT)
+        length &= ~FINAL_BIT
+        if length < TAG_SIZE or length > CHUNK_SIZE + TAG_SIZE:
+            raise ValueError('Encrypted backup is corrupt')
+
+        ciphertext = _read_exact(fileobj, length)
+        nonce = _nonce(prefix, counter, final)
+        try:
+            yield aesgcm.decrypt(nonce, ciphertext, header)
+        except InvalidTag:
+            raise ValueError('Encrypted backup failed authentication, '
+                             'wrong key or corrupt file')
+        counter += 1
+
+        if final:
+            if fileobj.read(1):
+                raise ValueError('Unexpected data after encrypted backup')
+            return
+
+
+def decompress_chunks(chunks):
+    """ Decompress an iterator of gzip data chunks """
+    decompressor = zlib.decompressobj(wbits=GZIP_WBITS)
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    data = decompressor.flush()
+    if data:
+        yield data
+    if not decompressor.eof:
+        raise ValueError('Compressed backup is truncated')
+    if decompressor.unused_data:
+        raise ValueError('Unexpected data after compressed backup')
+
+
+def open_reader(fileobj, compressed=False, key=None):
+    """ Undo open_writer, streaming the original data back
+    Args:
+        fileobj: binary file to read from
+        compressed: data is gzip compressed
+        key: encryption key, None if unencrypted
+    Returns:
+        Returns an iterator of original data chunks
+    """
+    if key is not None:
+        chunks = decrypt_chunks(fileobj, key)
+    else:
+        chunks = read_chunks(fileobj)
+    if compressed:
+        chunks = decompress_chunks(chunks)
+    return chunks
@@ -0,0 +1,256 @@
+# Rate and priority limits for dumps, restores and uploads
+
+import configparser
+import os
+import shutil
+import signal
+import subprocess
+import threading
+import time
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+DEFAULT_CONFIG = '~/.dumpfreeze/throttle.ini'
+
+# Size of reads passed through a limiter
+CHUNK_SIZE = 64 * 1024
+
+RATE_SUFFIXES = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+
+class TokenBucket(object):
+    """ Thread safe token bucket limiting throughput in bytes per second
+
+    A rate of None or 0 disables limiting.  The rate can be changed while
+    consumers are running, taking effect on their next call to consume.
+    """
+
+    def __init__(self, rate=None):
+        self._lock = threading.Lock()
+        self._rate = None
+        self._tokens = 0.0
+        self._last = time.monotonic()
+        self.set_rate(rate)
+
+    @property
+    def rate(self):
+        return self._rate
+
+    def set_rate(self, rate):
+        """ Change the rate limit
+        Args:
+            rate: bytes per second, None or 0 for unlimited
+        """
+        with self._lock:
+            self._rate = rate or None
+            # Allow up to one second of burst
+            self._tokens = min(self._tokens, self._rate or 0)
+            self._last = time.monotonic()
+
+    def consume(self, amount):
+        """ Take amount tokens from the bucket, sleeping if in debt
+        Args:
+            amount: number of bytes about to be transferred
+        """
+        with self._lock:
+            if not self._rate:
+                return
+            current = time.monotonic()
+            self._tokens = min(self._tokens +
+                               (current - self._last) * self._rate,
+                               self._rate)
+            self._last = current
+            # Going into debt makes later callers wait their turn
+            self._tokens -= amount
+            delay = -self._tokens / self._rate
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+# Shared by every dump and every upload worker in the process
+dump_limiter = TokenBucket()
+upload_limiter = TokenBucket()
+
+# Scheduling priority applied to dump and restore subprocesses
+priority = {'nice': None, 'ionice_class': None, 'ionice_level': None}
+
+# Subprocesses currently running under the priority settings
+_processes = set()
+_processes_lock = threading.Lock()
+
+
+def parse_rate(value):
+    """ Parse a rate such as 512K, 20M or 1G
+    Args:
+        value: rate string in bytes per second, empty for unlimited
+    Returns:
+        Returns the rate in bytes per second, or None for unlimited
+    """
+    value = value.strip().lower()
+    if not value:
+        return None
+    multiplier = RATE_SUFFIXES.get(value[-1])
+    if multiplier:
+        value = value[:-1]
+    return int(float(value) * (multiplier or 1))
+
+
+def read(stream, size, limiter):
+    """ Read up to size bytes from stream at the limiter's rate
+    Args:
+        stream: binary file object
+        size: maximum number of bytes to read
+        limiter: TokenBucket to draw from
+    Returns:
+        Returns the bytes read
+    """
+    data = stream.read(size)
+    limiter.consume(len(data))
+    return data
+
+
+class ThrottledReader(object):
+    """ File wrapper drawing every read from a limiter """
+
+    def __init__(self, fileobj, limiter):
+        self.fileobj = fileobj
+        self.limiter = limiter
+
+    def read(self, size=-1):
+        return read(self.fileobj, size, self.limiter)
+
+
+def _apply_priority(pid, reset=()):
+    """ Apply current priority settings to a process
+    Args:
+        pid: process id
+        reset: settings no longer configured, 'nice' and 'ionice', to
+            return to their defaults
+    """
+    nice = priority['nice']
+    if nice is None and 'nice' in reset:
+        # Subprocesses otherwise inherit dumpfreeze's own niceness
+        nice = os.getpriority(os.PRIO_PROCESS, 0)
+    if nice is not None:
+        try:
+            os.setpriority(os.PRIO_PROCESS, pid, nice)
+        except OSError as e:
+            logger.warning('Failed to set nice of %s: %s', pid, e)
+
+    ionice_class = priority['ionice_class']
+    ionice_level = priority['ionice_level']
+    if ionice_class is None and 'ionice' in reset:
+        # Class none, io priority follows niceness as by default
+        ionice_class, ionice_level = 0, None
+    if ionice_class is not None:
+        ionice = shutil.which('ionice')
+        if ionice is None:
+            logger.warning('ionice not found, skipping io priority')
+            return
+        ionice_args = [ionice, '-c', str(ionice_class)]
+        if ionice_level is not None:
+            ionice_args += ['-n', str(ionice_level)]
+        ionice_args += ['-p', str(pid)]
+        result = subprocess.run(ionice_args,
+                                stderr=subprocess.PIPE,
+                                universal_newlines=True)
+        if result.returncode:
+            logger.warning('Failed to set io priority of %s: %s',
+                           pid, result.stderr.strip())
+
+
+def register_process(process):
+    """ Apply priority settings to a subprocess and track it so later
+    changes reach it too
+    Args:
+        process: subprocess.Popen object
+    """
+    with _processes_lock:
+        _processes.add(process)
+    _apply_priority(process.pid)
+
+
+def unregister_process(process):
+    """ Stop tracking a finished subprocess
+    Args:
+        process: subprocess.Popen object
+    """
+    with _processes_lock:
+        _processes.discard(process)
+
+
+def configure(dump_rate=None, upload_rate=None, nice=None,
+              ionice_class=None, ionice_level=None):
+    """ Set limits, applying them to work already in progress
+    Args:
+        dump_rate: dump read rate in bytes per second
+        upload_rate: upload rate in bytes per second, shared by all uploads
+        nice: niceness of dump and restore subprocesses
+        ionice_class: ionice scheduling class of dump and restore
+        ionice_level: ionice priority within the scheduling class
+    """
+    dump_limiter.set_rate(dump_rate)
+    upload_limiter.set_rate(upload_rate)
+
+    # Settings removed since the last call are reset on running processes
+    reset = set()
+    if nice is None and priority['nice'] is not None:
+        reset.add('nice')
+    if ionice_class is None and priority['ionice_class'] is not None:
+        reset.add('ionice')
+
+    priority['nice'] = nice
+    priority['ionice_class'] = ionice_class
+    priority['ionice_level'] = ionice_level
+
+    with _processes_lock:
+        running = [p for p in _processes if p.poll() is None]
+    for process in running:
+        _apply_priority(process.pid, reset)
+
+    logger.info('Throttle set: dump %s B/s, upload %s B/s, nice %s, '
+                'ionice %s/%s', dump_rate, upload_rate, nice,
+                ionice_class, ionice_level)
+
+
+def load_config(path=DEFAULT_CONFIG):
+    """ Configure limits from the [throttle] section of an ini file,
+    a missing file leaves everything unlimited
+    Args:
+        path: Path to config file
+    """
+    parser = configparser.ConfigParser()
+    parser.read(os.path.expanduser(path))
+    section = parser['throttle'] if parser.has_section('throttle') else {}
+
+    def get_int(key):
+        value = section.get(key, '').strip()
+        return int(value) if value else None
+
+    configure(dump_rate=parse_rate(section.get('dump_rate', '')),
+              upload_rate=parse_rate(section.get('upload_rate', '')),
+              nice=get_int('nice'),
+              ionice_class=get_int('ionice_class'),
+              ionice_level=get_int('ionice_level'))
+
+
+def reload_on_sighup(path=DEFAULT_CONFIG):
+    """ Reload the config file whenever the process receives SIGHUP
+    Args:
+        path: Path to config file
+    """
+    def reload():
+        logger.info('Received SIGHUP, reloading %s', path)
+        try:
+            load_config(path)
+        except Exception as e:
+            logger.error('Failed to reload %s: %s', path, e)
+
+    def handler(signum, frame):
+        # The interrupted thread may hold a limiter, process or logging
+        # lock, so take none of them here and reload from another thread
+        threading.Thread(target=reload, daemon=True).start()
+
+    signal.signal(signal.SIGHUP, handler)
@@ -14,9 +14,10 @@ setup(
     packages=find_packages(),
     license='MIT',
     install_requires=['boto3', 'click', 'SQLAlchemy'],
+    extras_require={'encryption': ['cryptography']},
     entry_points={
         'console_scripts': [
-            'dumpfreeze = dumpfreeze.main'
+            'dumpfreeze = dumpfreeze.main:run'
         ]
     },
     )
@@ -0,0 +1,257 @@
+import os
+import sqlite3
+import botocore.exceptions
+import pytest
+from dumpfreeze import api
+from dumpfreeze import inventorydb
+
+# Inventory schema before sizes, backends and job tiers were recorded
+BASELINE_SCHEMA = '''
+CREATE TABLE archive (id VARCHAR NOT NULL, aws_id VARCHAR,
+    location VARCHAR, vault_name VARCHAR, database_name VARCHAR,
+    date VARCHAR, PRIMARY KEY (id));
+CREATE TABLE backup (id VARCHAR NOT NULL, database_name VARCHAR,
+    backup_dir VARCHAR, date VARCHAR, PRIMARY KEY (id));
+CREATE TABLE job (account_id VARCHAR, vault_name VARCHAR,
+    id VARCHAR NOT NULL, PRIMARY KEY (id));
+'''
+
+
+def not_found(*args):
+    raise botocore.exceptions.ClientError(
+        {'Error': {'Code': 'ResourceNotFoundException',
+                   'Message': 'The job ID was not found'}},
+        'DescribeJob')
+
+
+@pytest.fixture
+def manager(tmp_path):
+    return api.BackupManager(str(tmp_path / 'inventory.db'),
+                             storage_config=str(tmp_path / 'storage.ini'))
+
+
+def add_job(manager, job_id):
+    return manager._store(inventorydb.Job(id=job_id, account_id='-',
+                                          vault_name='vault',
+                                          backend='glacier'))
+
+
+def test_upgrade_baseline_inventory(tmp_path):
+    path = str(tmp_path / 'inventory.db')
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.execute("INSERT INTO job VALUES ('123', 'vault', 'J1')")
+    conn.commit()
+    conn.close()
+
+    manager = api.BackupManager(path,
+                                storage_config=str(tmp_path / 'none.ini'))
+
+    job_info = manager.get_job('J1')
+    assert job_info.date is None
+    assert job_info.backend is None
+    assert manager.stats()['totals']['backups'] == 0
+
+
+def test_poll_jobs_removes_unknown_jobs(manager):
+    add_job(manager, 'J1')
+    manager.backends['glacier'].check_job = not_found
+
+    assert manager.poll_jobs() == []
+    assert manager.list_jobs() == []
+
+
+def test_poll_jobs_isolates_failures(manager):
+    for job_id in ('J1', 'J2', 'J3'):
+        add_job(manager, job_id)
+    checked = []
+
+    def check_job(job_info):
+        checked.append(job_info.id)
+        if job_info.id == 'J1':
+            raise ValueError('describe failed')
+        if job_info.id == 'J2':
+            not_found()
+        return False
+
+    manager.backends['glacier'].check_job = check_job
+
+    assert manager.poll_jobs() == []
+    assert sorted(checked) == ['J1', 'J2', 'J3']
+    # The failed job is kept for the next run, the unknown one dropped
+    assert sorted(j.id for j in manager.list_jobs()) == ['J1', 'J3']
+
+
+def test_poll_job_other_client_errors_raise(manager):
+    job_info = add_job(manager, 'J1')
+
+    def check_job(job_info):
+        raise botocore.exceptions.ClientError(
+            {'Error': {'Code': 'ThrottlingException', 'Message': 'slow'}},
+            'DescribeJob')
+
+    manager.backends['glacier'].check_job = check_job
+
+    with pytest.raises(botocore.exceptions.ClientError):
+        manager.poll_job(job_info)
+    assert [j.id for j in manager.list_jobs()] == ['J1']
+
+
+# Storage backends, exercised end to end with local directories
+@pytest.fixture
+def local_manager(tmp_path, monkeypatch):
+    """ Manager with a fake mysqldump and a faster local backend, fast,
+    alongside the default local one
+    """
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    mysqldump = bin_dir / 'mysqldump'
+    mysqldump.write_text('#!/bin/sh\n'
+                         'echo "-- dump of $2"\n'
+                         'seq 1 20000\n')
+    mysqldump.chmod(0o755)
+    monkeypatch.setenv('PATH', '%s:%s' % (bin_dir, os.environ['PATH']))
+
+    config = tmp_path / 'storage.ini'
+    config.write_text('[fast]\ntype = local\npriority = -1\n')
+    for name in ('fast', 'slow', 'backups', 'retrieved'):
+        (tmp_path / name).mkdir()
+
+    # Vaults are given relative to the cwd at upload time
+    monkeypatch.chdir(tmp_path)
+    return api.BackupManager(str(tmp_path / 'inventory.db'),
+                             storage_config=str(config))
+
+
+def upload_both(manager, tmp_path):
+    backup_info = manager.create_backup('db1', backup_dir=str(
+        tmp_path / 'backups'), compress=True)
+    slow = manager.upload_backup(backup_info.id, 'slow', 'local')
+    fast = manager.upload_backup(backup_info.id, 'fast', 'fast')
+    return backup_info, slow, fast
+
+
+def read_backup(manager, backup_info):
+    with open(manager._backup_path(backup_info), 'rb') as f:
+        return f.read()
+
+
+def test_local_vault_stored_absolute(local_manager, tmp_path, monkeypatch):
+    backup_info, slow, fast = upload_both(local_manager, tmp_path)
+
+    assert slow.vault_name == str(tmp_path / 'slow')
+    assert slow.location == str(tmp_path / 'slow' / slow.aws_id)
+
+    # Still found from another directory
+    monkeypatch.chdir(tmp_path / 'backups')
+    assert local_manager.inventory('local', str(tmp_path / 'slow')) == [
+        slow.aws_id]
+    retrieved = local_manager.retrieve_archive(slow.id, backup_dir=str(
+        tmp_path / 'retrieved'))
+    assert retrieved.source_archive_id == fast.id
+
+
+def test_list_copies_fastest_first(local_manager, tmp_path):
+    backup_info, slow, fast = upload_both(local_manager, tmp_path)
+
+    for archive_info in (slow, fast):
+        copies = local_manager.list_copies(archive_info.id)
+        assert [c.id for c in copies] == [fast.id, slow.id]
+
+
+def test_retrieve_from_fastest_copy(local_manager, tmp_path):
+    backup_info, slow, fast = upload_both(local_manager, tmp_path)
+
+    retrieved = local_manager.retrieve_archive(slow.id, backup_dir=str(
+        tmp_path / 'retrieved'))
+
+    assert retrieved.source_archive_id == fast.id
+    assert retrieved.checksum == backup_info.checksum
+    assert retrieved.raw_size is None
+    assert read_backup(local_manager, retrieved) == read_backup(
+        local_manager, backup_info)
+
+
+def test_retrieve_falls_back_on_missing_copy(local_manager, tmp_path):
+    backup_info, slow, fast = upload_both(local_manager, tmp_path)
+    os.remove(fast.location)
+
+    retrieved = local_manager.retrieve_archive(fast.id, backup_dir=str(
+        tmp_path / 'retrieved'))
+
+    assert retrieved.source_archive_id == slow.id
+    assert read_backup(local_manager, retrieved) == read_backup(
+        local_manager, backup_info)
+
+
+def test_retrieve_rejects_corrupt_copy(local_manager, tmp_path):
+    backup_info, slow, fast = upload_both(local_manager, tmp_path)
+    with open(fast.location, 'r+b') as f:
+        f.write(b'corrupt')
+
+    retrieved = local_manager.retrieve_archive(fast.id, backup_dir=str(
+        tmp_path / 'retrieved'))
+
+    assert retrieved.source_archive_id == slow.id
+    # The corrupt download was removed
+    assert os.listdir(str(tmp_path / 'retrieved')) == [
+        os.path.basename(local_manager._backup_path(retrieved))]
+
+
+def test_retrieve_fails_when_no_copy_is_good(local_manager, tmp_path):
+    backup_info, slow, fast = upload_both(local_manager, tmp_path)
+    os.remove(fast.location)
+    with open(slow.location, 'r+b') as f:
+        f.write(b'corrupt')
+
+    with pytest.raises(ValueError, match='Checksum mismatch'):
+        local_manager.retrieve_archive(fast.id, backup_dir=str(
+            tmp_path / 'retrieved'))
+    assert os.listdir(str(tmp_path / 'retrieved')) == []
+    assert len(local_manager.list_backups()) == 1
+
+
+def test_delete_archive(local_manager, tmp_path):
+    backup_info, slow, fast = upload_both(local_manager, tmp_path)
+
+    local_manager.delete_archive(fast.id)
+
+    assert not os.path.exists(fast.location)
+    assert os.path.exists(slow.location)
+    assert [a.id for a in local_manager.list_archives()] == [slow.id]
+    assert [c.id for c in local_manager.list_copies(slow.id)] == [slow.id]
+
+
+def test_stats_leave_out_retrieved_copies(local_manager, tmp_path):
+    backup_info, slow, fast = upload_both(local_manager, tmp_path)
+    retrieved = local_manager.retrieve_archive(slow.id, backup_dir=str(
+        tmp_path / 'retrieved'))
+
+    stats = local_manager.stats()
+
+    assert stats['totals']['backups'] == 2
+    assert stats['totals']['dumps'] == 1
+    assert stats['totals']['raw_size'] == backup_info.raw_size
+    assert stats['totals']['compressed_size'] == (
+        backup_info.compressed_size + retrieved.compressed_size)
+    database, = stats['databases']
+    assert (database['backups'], database['dumps']) == (2, 1)
+    assert [row['id'] for row in stats['largest']] == [backup_info.id]
+
+
+def test_stats_growth_against_calendar_month(manager):
+    for backup_id, date, size in (('B1', '2024-01-10', 100),
+                                  ('B2', '2024-02-10', 150),
+                                  ('B3', '2024-04-10', 300)):
+        manager._store(inventorydb.Backup(id=backup_id, date=date,
+                                          compressed_size=size))
+    manager._store(inventorydb.Archive(id='A1', date='2024-02-10',
+                                       archived_size=150))
+
+    months = dict((row['month'], row) for row in manager.stats()['months'])
+
+    assert months['2024-01']['local_growth'] is None
+    assert months['2024-02']['local_growth'] == 0.5
+    # March has nothing stored, so April has nothing to compare with
+    assert months['2024-04']['local_growth'] is None
+    assert months['2024-02']['archived_growth'] is None
@@ -0,0 +1,73 @@
+import pytest
+from dumpfreeze import aws
+from dumpfreeze import throttle
+
+MIB = 1024 * 1024
+
+
+@pytest.fixture
+def consumed(monkeypatch):
+    amounts = []
+    monkeypatch.setattr(throttle.upload_limiter, 'consume', amounts.append)
+    return amounts
+
+
+@pytest.fixture
+def backup_file(tmp_path):
+    path = tmp_path / 'backup.sql'
+    path.write_bytes(bytes(range(256)) * 100)
+    return str(path)
+
+
+def test_part_window(backup_file):
+    with aws._ThrottledPart(backup_file, 1000, 500) as part:
+        assert len(part) == 500
+        assert part.read(10) == (bytes(range(256)) * 100)[1000:1010]
+        assert part.tell() == 10
+        part.seek(0, 2)
+        assert part.read() == b''
+        part.seek(-5, 1)
+        assert len(part.read()) == 5
+
+    # The last part stops at the end of the file
+    with aws._ThrottledPart(backup_file, 25000, 1000) as part:
+        assert len(part) == 600
+        assert len(part.read()) == 600
+
+
+def test_part_only_paced_while_sending(backup_file, consumed):
+    with aws._ThrottledPart(backup_file, 0, 4096) as part:
+        # botocore checksumming and signing the body
+        part.read()
+        part.seek(0)
+        assert consumed == []
+
+        part.signal_transferring()
+        part.read(1024)
+        part.read()
+        assert sum(consumed) == 4096
+
+        # A retry rewinds and resends, which is paced again
+        part.signal_not_transferring()
+        part.seek(0)
+        part.signal_transferring()
+        part.read()
+        assert sum(consumed) == 8192
+
+
+def test_glacier_part_hashes_unpaced(backup_file, consumed):
+    with aws._GlacierPart(backup_file, 0, 3 * MIB) as part:
+        assert len(part.leaves) == 1
+        assert part.tell() == 0
+    assert consumed == []
+
+
+def test_part_size_within_part_limit():
+    assert aws._part_size(1) == aws.PART_SIZE
+    assert aws._part_size(aws.PART_SIZE * aws.MAX_PARTS) == aws.PART_SIZE
+    assert aws._part_size(aws.PART_SIZE * aws.MAX_PARTS + 1) == (
+        2 * aws.PART_SIZE)
+    assert aws._part_size(30 * 1024 ** 4) == aws.MAX_PART_SIZE
+
+    with pytest.raises(ValueError):
+        aws._part_size(aws.MAX_PART_SIZE * aws.MAX_PARTS + 1)
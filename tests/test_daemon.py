@@ -0,0 +1,267 @@
+import concurrent.futures
+import datetime
+import socket
+import threading
+import pytest
+from sqlalchemy.orm.exc import NoResultFound
+from dumpfreeze import daemon
+from dumpfreeze import inventorydb
+from dumpfreeze.api import DATETIME_FORMAT, INVENTORY_JOB
+
+NOW = datetime.datetime(2024, 5, 1, 12, 0, 0)
+
+
+def job(job_id='J1', tier='Standard', date=None, job_type=None):
+    return inventorydb.Job(id=job_id, tier=tier, date=date,
+                           job_type=job_type, vault_name='vault',
+                           account_id='-', backend='glacier')
+
+
+def started(delta):
+    return (NOW - delta).strftime(DATETIME_FORMAT)
+
+
+class FakeManager(object):
+    """ Just enough of api.BackupManager for the daemon """
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.jobs = {}
+        self.polled = []
+        self.backups = []
+        self.poll_error = None
+        self.backup_error = None
+        self.release = threading.Event()
+        self.release.set()
+
+    def get_job(self, job_id):
+        try:
+            return self.jobs[job_id]
+        except KeyError:
+            raise NoResultFound()
+
+    def list_jobs(self):
+        return list(self.jobs.values())
+
+    def poll_job(self, job_info, backup_dir=None):
+        self.polled.append(job_info.id)
+        if self.poll_error is not None:
+            raise self.poll_error
+        return None
+
+    def create_backup(self, database, *args):
+        self.release.wait(5)
+        self.backups.append(database)
+        if self.backup_error is not None:
+            raise self.backup_error
+        return inventorydb.Backup(id='B%d' % len(self.backups))
+
+
+@pytest.fixture
+def scheduler(tmp_path):
+    manager = FakeManager(str(tmp_path / 'daemon.sock'))
+    scheduler = daemon.Daemon(manager, str(tmp_path),
+                              databases=['db1'],
+                              backup_interval=datetime.timedelta(hours=1))
+    scheduler._listen()
+    yield scheduler
+    manager.release.set()
+    scheduler._close()
+
+
+def finish(scheduler):
+    """ Wait for every running action, then reap them """
+    concurrent.futures.wait(list(scheduler._running.values()), timeout=5)
+    scheduler._reap()
+
+
+def queued(scheduler):
+    return sorted((action, key) for _, _, action, key in scheduler._queue)
+
+
+# next_poll
+def test_next_poll_undated_job_checked_now_only_once():
+    job_info = job(date=None)
+    interval = daemon.TIER_SCHEDULE['Standard'][1]
+
+    assert daemon.next_poll(job_info, NOW, first_check=True) == NOW
+    # Rechecking at the same time would spin the scheduling loop
+    assert daemon.next_poll(job_info, NOW) == NOW + interval
+
+
+def test_next_poll_unparseable_date():
+    job_info = job(tier='Bulk', date='yesterday')
+    assert daemon.next_poll(job_info, NOW) == (
+        NOW + daemon.TIER_SCHEDULE['Bulk'][1])
+
+
+def test_next_poll_waits_until_tier_could_be_ready():
+    job_info = job(tier='Standard', date=started(datetime.timedelta(hours=1)))
+    assert daemon.next_poll(job_info, NOW) == NOW + datetime.timedelta(hours=2)
+
+
+def test_next_poll_backs_off_with_age():
+    first, interval = daemon.TIER_SCHEDULE['Expedited']
+    job_info = job(tier='Expedited', date=started(first))
+    assert daemon.next_poll(job_info, NOW) == NOW + interval
+
+    job_info.date = started(first + datetime.timedelta(minutes=40))
+    assert daemon.next_poll(job_info, NOW) == (
+        NOW + interval + datetime.timedelta(minutes=10))
+
+
+def test_next_poll_interval_is_capped():
+    job_info = job(tier='Standard', date=started(datetime.timedelta(days=3)))
+    assert daemon.next_poll(job_info, NOW) == NOW + daemon.MAX_POLL_INTERVAL
+
+
+def test_next_poll_unknown_tier_uses_standard():
+    job_info = job(tier=None, date=started(datetime.timedelta(hours=1)))
+    assert daemon.next_poll(job_info, NOW) == NOW + datetime.timedelta(hours=2)
+
+
+# Scheduling
+def test_schedule_dedupes_polls(scheduler):
+    scheduler.schedule(NOW, 'poll', 'J1')
+    scheduler.schedule(NOW, 'poll', 'J1')
+    scheduler.schedule(NOW, 'backup', 'db1')
+
+    assert queued(scheduler) == [('backup', 'db1'), ('poll', 'J1')]
+
+
+def test_load_jobs_skips_inventory_jobs(scheduler):
+    manager = scheduler.manager
+    manager.jobs['J1'] = job('J1')
+    manager.jobs['J2'] = job('J2', job_type=INVENTORY_JOB)
+
+    scheduler._load_jobs()
+
+    assert queued(scheduler) == [('poll', 'J1')]
+
+
+def test_undated_job_does_not_spin(scheduler):
+    manager = scheduler.manager
+    manager.jobs['J1'] = job('J1', date=None)
+    scheduler._load_jobs()
+
+    scheduler._run_pending()
+    finish(scheduler)
+    scheduler._run_pending()
+    finish(scheduler)
+
+    assert manager.polled == ['J1']
+    assert scheduler._queue[0][0] > daemon.now()
+
+
+def test_receive_schedules_notified_job(scheduler):
+    scheduler.manager.jobs['J1'] = job('J1', date=None)
+
+    assert daemon.notify(scheduler.socket_path, 'J1')
+    scheduler._receive()
+
+    assert queued(scheduler) == [('poll', 'J1')]
+
+
+def test_finished_job_not_rescheduled(scheduler):
+    manager = scheduler.manager
+    manager.jobs['J1'] = job('J1')
+    scheduler.schedule(NOW, 'poll', 'J1')
+
+    # The job completes, or its backend forgot it, and it is removed
+    manager.poll_job = lambda job_info, backup_dir: manager.jobs.clear()
+    scheduler._run_pending()
+    finish(scheduler)
+
+    assert scheduler._queue == []
+
+
+def test_failed_poll_rescheduled(scheduler):
+    manager = scheduler.manager
+    manager.jobs['J1'] = job('J1')
+    manager.poll_error = ValueError('describe failed')
+    scheduler.schedule(NOW, 'poll', 'J1')
+
+    scheduler._run_pending()
+    finish(scheduler)
+
+    assert manager.polled == ['J1']
+    assert queued(scheduler) == [('poll', 'J1')]
+
+
+# Backups
+def test_backup_runs_off_the_scheduling_thread(scheduler):
+    manager = scheduler.manager
+    manager.release.clear()
+    scheduler.schedule(NOW, 'backup', 'db1')
+
+    # Returns while the backup is still blocked
+    scheduler._run_pending()
+    assert ('backup', 'db1') in scheduler._running
+    assert manager.backups == []
+
+    manager.release.set()
+    finish(scheduler)
+    assert manager.backups == ['db1']
+    assert queued(scheduler) == [('backup', 'db1')]
+    assert scheduler._running == {}
+
+
+def test_backup_not_run_twice_at_once(scheduler):
+    manager = scheduler.manager
+    manager.release.clear()
+    scheduler.schedule(NOW, 'backup', 'db1')
+    scheduler._run_pending()
+    scheduler.schedule(NOW, 'backup', 'db1')
+    scheduler._run_pending()
+
+    manager.release.set()
+    finish(scheduler)
+    assert manager.backups == ['db1']
+    # Only the finished backup queues the next one
+    assert queued(scheduler) == [('backup', 'db1')]
+
+
+def test_failed_backup_rescheduled(scheduler):
+    manager = scheduler.manager
+    manager.backup_error = OSError('mysqldump failed')
+    scheduler.schedule(NOW, 'backup', 'db1')
+
+    scheduler._run_pending()
+    finish(scheduler)
+
+    assert queued(scheduler) == [('backup', 'db1')]
+    when = scheduler._queue[0][0]
+    assert when > daemon.now() + datetime.timedelta(minutes=59)
+
+
+def test_finished_worker_wakes_loop(scheduler):
+    scheduler.schedule(NOW, 'backup', 'db1')
+    scheduler._run_pending()
+    finish(scheduler)
+
+    scheduler._wakeup[0].settimeout(5)
+    assert scheduler._wakeup[0].recv(1024)
+
+
+# Notification socket
+def test_refuses_to_replace_live_socket(scheduler):
+    other = daemon.Daemon(scheduler.manager, '/tmp')
+
+    with pytest.raises(RuntimeError, match='Another daemon'):
+        other._listen()
+    # The running daemon still receives notifications
+    assert daemon.notify(scheduler.socket_path, 'J1')
+
+
+def test_replaces_stale_socket(tmp_path):
+    path = str(tmp_path / 'daemon.sock')
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    stale.bind(path)
+    stale.close()
+
+    scheduler = daemon.Daemon(FakeManager(path), str(tmp_path))
+    scheduler._listen()
+    try:
+        assert daemon.notify(path, 'J1')
+    finally:
+        scheduler._close()
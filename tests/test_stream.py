@@ -0,0 +1,127 @@
+import hashlib
+import io
+import os
+import pytest
+from dumpfreeze import stream
+
+needs_crypto = pytest.mark.skipif(stream.AESGCM is None,
+                                  reason='cryptography not installed')
+
+KEY = b'k' * stream.KEY_SIZE
+
+# Sizes either side of the encrypted chunk boundaries
+SIZES = [0, 1,
+         stream.CHUNK_SIZE - 1, stream.CHUNK_SIZE, stream.CHUNK_SIZE + 1,
+         2 * stream.CHUNK_SIZE, 3 * stream.CHUNK_SIZE + 5]
+
+# (compress, encrypt) combinations
+MODES = [(False, False),
+         (True, False),
+         pytest.param(False, True, marks=needs_crypto),
+         pytest.param(True, True, marks=needs_crypto)]
+
+# Modes whose framing can tell the stream was cut short
+FRAMED_MODES = MODES[1:]
+
+
+def sample(size):
+    """ Half random, half repetitive data, so compression does something """
+    half = size // 2
+    return os.urandom(half) + b'INSERT INTO t VALUES (1);\n' * (
+        (size - half) // 26 + 1)
+
+
+def write(data, compress, encrypt, key=KEY):
+    out = io.BytesIO()
+    writer, hasher = stream.open_writer(out, compress,
+                                        key if encrypt else None)
+    # Feed in uneven pieces, as a dump arrives
+    for i in range(0, len(data), 10000):
+        writer.write(data[i:i + 10000])
+    writer.close()
+    return out.getvalue(), hasher
+
+
+def read(stored, compress, encrypt, key=KEY):
+    chunks = stream.open_reader(io.BytesIO(stored), compress,
+                                key if encrypt else None)
+    return b''.join(chunks)
+
+
+@pytest.mark.parametrize('compress,encrypt', MODES)
+@pytest.mark.parametrize('size', SIZES)
+def test_round_trip(size, compress, encrypt):
+    data = sample(size)[:size]
+    stored, hasher = write(data, compress, encrypt)
+
+    assert hasher.size == len(stored)
+    assert hasher.checksum == hashlib.sha256(stored).hexdigest()
+    assert read(stored, compress, encrypt) == data
+
+
+@needs_crypto
+def test_nonce_prefix_is_random():
+    first, _ = write(b'data', False, True)
+    second, _ = write(b'data', False, True)
+    assert first != second
+
+
+@pytest.mark.parametrize('compress,encrypt', FRAMED_MODES)
+def test_truncated(compress, encrypt):
+    stored, _ = write(sample(3 * stream.CHUNK_SIZE), compress, encrypt)
+
+    for cut in (1, 100, len(stored) // 2):
+        with pytest.raises(ValueError):
+            read(stored[:-cut], compress, encrypt)
+
+
+@needs_crypto
+@pytest.mark.parametrize('compress', [False, True])
+def test_dropped_final_frame(compress):
+    stored, _ = write(sample(3 * stream.CHUNK_SIZE), compress, True)
+
+    # Walk the frames to find where the final one starts
+    offset = stream.HEADER_SIZE
+    while True:
+        length, = stream.FRAME.unpack_from(stored, offset)
+        if length & stream.FINAL_BIT:
+            break
+        offset += stream.FRAME.size + length
+    assert offset > stream.HEADER_SIZE
+
+    with pytest.raises(ValueError, match='truncated'):
+        read(stored[:offset], compress, True)
+
+
+@needs_crypto
+@pytest.mark.parametrize('compress', [False, True])
+def test_wrong_key(compress):
+    stored, _ = write(sample(stream.CHUNK_SIZE + 1), compress, True)
+
+    with pytest.raises(ValueError, match='authentication'):
+        read(stored, compress, True, key=b'w' * stream.KEY_SIZE)
+
+
+@needs_crypto
+def test_corrupt_chunk():
+    stored = bytearray(write(sample(stream.CHUNK_SIZE), False, True)[0])
+    stored[stream.HEADER_SIZE + stream.FRAME.size + 10] ^= 1
+
+    with pytest.raises(ValueError, match='authentication'):
+        read(bytes(stored), False, True)
+
+
+@pytest.mark.parametrize('compress,encrypt', FRAMED_MODES)
+def test_trailing_data(compress, encrypt):
+    stored, _ = write(sample(stream.CHUNK_SIZE + 1), compress, encrypt)
+
+    with pytest.raises(ValueError, match='after'):
+        read(stored + b'trailing', compress, encrypt)
+
+
+@needs_crypto
+def test_not_encrypted():
+    stored, _ = write(sample(100), True, False)
+
+    with pytest.raises(ValueError, match='Not an encrypted'):
+        read(stored, True, True)
@@ -0,0 +1,53 @@
+import os
+import shutil
+import subprocess
+import pytest
+from dumpfreeze import throttle
+
+
+@pytest.fixture
+def process():
+    process = subprocess.Popen(['sleep', '30'])
+    throttle.register_process(process)
+    yield process
+    throttle.configure()
+    throttle.unregister_process(process)
+    process.kill()
+    process.wait()
+
+
+def ionice_of(pid):
+    return subprocess.check_output(['ionice', '-p', str(pid)],
+                                   universal_newlines=True).strip()
+
+
+def test_parse_rate():
+    assert throttle.parse_rate('') is None
+    assert throttle.parse_rate('512') == 512
+    assert throttle.parse_rate('1.5K') == 1536
+    assert throttle.parse_rate('20m') == 20 * 1024 ** 2
+
+
+def test_configure_applies_to_running_process(process):
+    throttle.configure(nice=5)
+    assert os.getpriority(os.PRIO_PROCESS, process.pid) == 5
+
+
+@pytest.mark.skipif(os.geteuid() != 0,
+                    reason='lowering niceness needs privileges')
+def test_removed_nice_resets_running_process(process):
+    own = os.getpriority(os.PRIO_PROCESS, 0)
+    throttle.configure(nice=own + 5)
+    throttle.configure(nice=None)
+    assert os.getpriority(os.PRIO_PROCESS, process.pid) == own
+
+
+@pytest.mark.skipif(shutil.which('ionice') is None,
+                    reason='ionice not installed')
+def test_removed_ionice_resets_running_process(process):
+    default = ionice_of(process.pid)
+    throttle.configure(ionice_class=3)
+    assert ionice_of(process.pid) == 'idle'
+
+    throttle.configure(ionice_class=None)
+    assert ionice_of(process.pid) == default